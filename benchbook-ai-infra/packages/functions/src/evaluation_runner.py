@@ -14,7 +14,9 @@ Author: BenchBook AI Team
 
 import os
 import json
+import statistics
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from typing import Dict, List, Any, Optional
 from dataclasses import dataclass, asdict
@@ -34,6 +36,8 @@ import tiktoken
 
 PINECONE_API_KEY = os.environ.get("PINECONE_API_KEY")
 PINECONE_INDEX = os.environ.get("PINECONE_INDEX", "benchbook-legal")
+# Index host URL; point at scripts/search_server.py (e.g. http://localhost:8765) to evaluate locally
+PINECONE_HOST = os.environ.get("PINECONE_HOST")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 LANGSMITH_API_KEY = os.environ.get("LANGSMITH_API_KEY")
 PROMPT_VERSION = os.environ.get("PROMPT_VERSION", "v1")
@@ -46,6 +50,16 @@ EMBEDDING_DIMENSIONS = 3072
 # RAG parameters
 TOP_K = 5  # Number of chunks to retrieve
 
+# Hedged query embedding: a call still running at this percentile of recent
+# call latencies gets a duplicate, and whichever answers first is used
+EMBED_TIMEOUT = float(os.environ.get("EMBED_TIMEOUT", "10"))  # seconds, hedge included
+EMBED_HEDGE_PERCENTILE = int(os.environ.get("EMBED_HEDGE_PERCENTILE", "95"))  # 1-99; 0 disables
+EMBED_HEDGE_MIN_SAMPLES = 10  # calls observed before the percentile is trusted
+EMBED_HEDGE_DEFAULT_DELAY = 1.0  # seconds, used until then
+if not 0 <= EMBED_HEDGE_PERCENTILE <= 99:
+    raise ValueError(f"EMBED_HEDGE_PERCENTILE must be 1-99, or 0 to disable hedging; "
+                     f"got {EMBED_HEDGE_PERCENTILE}")
+
 # Initialize logging
 structlog.configure(
     processors=[
@@ -64,6 +78,9 @@ openai_client = OpenAI(api_key=OPENAI_API_KEY)
 langsmith_client = LangSmithClient(api_key=LANGSMITH_API_KEY)
 pc = Pinecone(api_key=PINECONE_API_KEY)
 tokenizer = tiktoken.encoding_for_model("gpt-4")
+embed_executor = ThreadPoolExecutor(max_workers=4)
+embed_latencies: List[float] = []  # seconds taken by recent successful embedding calls
+embed_hedges = {"issued": 0, "won": 0}
 
 
 # =============================================================================
@@ -189,21 +206,64 @@ Prompt Version: {prompt_version}
 # RAG PIPELINE
 # =============================================================================
 
-@traceable(name="embed_query", tags=["embedding", PROMPT_VERSION])
-def embed_query(query: str) -> List[float]:
-    """Generate embedding for a query."""
+def create_embedding(query: str) -> List[float]:
+    """One embeddings API call; records its latency for hedging."""
+    start = time.time()
     response = openai_client.embeddings.create(
         model=EMBEDDING_MODEL,
         input=query,
         dimensions=EMBEDDING_DIMENSIONS,
+        timeout=EMBED_TIMEOUT,
     )
+    embed_latencies.append(time.time() - start)
+    del embed_latencies[:-200]
     return response.data[0].embedding
 
 
+def hedge_delay() -> float:
+    """Seconds to wait for an embedding call before sending a duplicate."""
+    if len(embed_latencies) < EMBED_HEDGE_MIN_SAMPLES:
+        return EMBED_HEDGE_DEFAULT_DELAY
+    return statistics.quantiles(embed_latencies, n=100)[EMBED_HEDGE_PERCENTILE - 1]
+
+
+@traceable(name="embed_query", tags=["embedding", PROMPT_VERSION])
+def embed_query(query: str) -> List[float]:
+    """Generate embedding for a query, hedging slow calls with a duplicate request."""
+    if EMBED_HEDGE_PERCENTILE == 0:
+        return create_embedding(query)
+
+    deadline = time.time() + EMBED_TIMEOUT
+    delay = hedge_delay()
+    first = embed_executor.submit(create_embedding, query)
+    done, _ = wait([first], timeout=min(delay, EMBED_TIMEOUT))
+    if done:
+        return first.result()
+    if delay >= EMBED_TIMEOUT:  # timed out before a hedge was due
+        raise TimeoutError(f"Embedding not returned within {EMBED_TIMEOUT}s")
+
+    embed_hedges["issued"] += 1
+    hedge = embed_executor.submit(create_embedding, query)
+    pending = {first, hedge}
+    while pending:
+        done, pending = wait(pending, timeout=max(deadline - time.time(), 0),
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    embed_hedges["won"] += 1
+                return future.result()
+            if not pending:
+                raise future.exception()
+    raise TimeoutError(f"Embedding not returned within {EMBED_TIMEOUT}s")
+
+
 @traceable(name="retrieve_context", tags=["retrieval", "pinecone", PROMPT_VERSION])
 def retrieve_context(query: str, top_k: int = TOP_K) -> List[Dict[str, Any]]:
     """Retrieve relevant chunks from Pinecone."""
-    index = pc.Index(PINECONE_INDEX)
+    index = pc.Index(host=PINECONE_HOST) if PINECONE_HOST else pc.Index(PINECONE_INDEX)
     
     query_embedding = embed_query(query)
     
@@ -405,6 +465,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         Evaluation report
     """
     start_time = datetime.utcnow()
+    embed_hedges.update(issued=0, won=0)  # counted per evaluation run
     
     try:
         # Parse optional filters
@@ -471,6 +532,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 "avg_citation_accuracy": avg_citation_accuracy,
                 "avg_response_time_ms": avg_response_time,
             },
+            "embedding_hedges": dict(embed_hedges),
             "category_breakdown": categories,
             "results": [asdict(r) for r in results],
             "failed_queries": [
@@ -494,6 +556,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             passed=passed,
             failed=total - passed,
             processing_time=processing_time,
+            embedding_hedges_issued=embed_hedges["issued"],
+            embedding_hedges_won=embed_hedges["won"],
         )
         
         return {
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the search server's hot path.
+
+Times load_chunks() and each stage of a dense search -- scoring, per-section
+top-k selection, Python-side result assembly -- plus search() end to end,
+across corpus sizes, embedding dimensions, top_k values and scoring
+precisions. Runs offline on synthetic corpora (no API key, no server).
+
+Each run appends one JSON line to the history file and is compared with
+the most recent earlier run on the same machine; timings that got slower
+by more than --tolerance are flagged.
+
+Usage:
+    python3 scripts/bench_search.py
+    python3 scripts/bench_search.py --sizes 10000,100000 --dims 256,1024,3072
+    python3 scripts/bench_search.py --precisions float32,int8 --fail-on-regression
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from loadtest_search import WORK_DIR, git_revision, synthetic_corpus
+from search_server import (PRECISIONS, PROJECT_ROOT, QUANT_RESCORE, QuantizedMatrix,
+                           SectionGroups, collect_results, load_chunks, search, search_many,
+                           select)
+
+HISTORY_PATH = PROJECT_ROOT / "benchmarks" / "bench_search.jsonl"
+
+SIZES = (10000, 50000)
+DIMS = (256, 3072)
+TOP_KS = (5, 20)
+QUERIES = 50        # timed query vectors per configuration
+WARMUP = 3          # untimed calls before each measurement
+BATCH = 16          # queries per search_many() call
+TOLERANCE = 0.25    # median slowdown flagged as a regression; run-to-run noise is ~15%
+
+
+def measure(fn, args_list: list) -> dict:
+    """Call fn(*args) for each entry of `args_list`; returns median/p95 milliseconds."""
+    for args in args_list[:WARMUP]:
+        fn(*args)
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {"median_ms": round(statistics.median(timings), 4),
+            "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 4)}
+
+
+def bench_corpus(size: int, dim: int, top_ks: tuple, precisions: tuple, queries: int,
+                 work_dir: Path) -> list:
+    """All measurements for one synthetic corpus of `size` x `dim`."""
+    results = []
+    config = {"chunks": size, "dim": dim}
+
+    path = synthetic_corpus(size, dim, work_dir)
+    start = time.perf_counter()
+    metadata, matrix = load_chunks(path)
+    results.append({"name": "load_chunks", **config,
+                    "median_ms": round((time.perf_counter() - start) * 1000, 2)})
+    start = time.perf_counter()
+    groups = SectionGroups(metadata)
+    results.append({"name": "section_groups", **config,
+                    "median_ms": round((time.perf_counter() - start) * 1000, 2)})
+
+    rng = np.random.default_rng(1)
+    query_vecs = rng.standard_normal((queries, dim), dtype=np.float32)
+    query_vecs /= np.linalg.norm(query_vecs, axis=1, keepdims=True)
+    single = [(vec,) for vec in query_vecs]
+
+    for precision in precisions:
+        quantized = None if precision == "float32" else QuantizedMatrix.build(matrix, precision)
+        score = (lambda q: matrix @ q) if quantized is None else quantized.scores
+        entry = {**config, "precision": precision}
+        results.append({"name": "score", **entry, **measure(score, single)})
+
+        scores = [(score(vec),) for vec in query_vecs[:WARMUP + 5]]
+        for top_k in top_ks:
+            entry = {**config, "precision": precision, "top_k": top_k}
+            n = top_k * QUANT_RESCORE if quantized is not None else top_k
+            results.append({"name": "select", **entry,
+                            **measure(lambda s: select(s, n, groups=groups), scores)})
+            ranked = [(select(s, top_k, groups=groups),) for s, in scores]
+            results.append({"name": "collect_results", **entry,
+                            **measure(lambda r: collect_results(*r, metadata, top_k), ranked)})
+            results.append({"name": "search", **entry, **measure(
+                lambda q: search(q, matrix, metadata, top_k=top_k, groups=groups,
+                                 quantized=quantized), single)})
+            batches = [(query_vecs[i:i + BATCH],)
+                       for i in range(0, len(query_vecs) - BATCH + 1, BATCH)] or [(query_vecs,)]
+            batch_size = len(batches[0][0])
+            timing = measure(lambda qs: search_many(qs, matrix, metadata, top_k=top_k,
+                                                    groups=groups, quantized=quantized), batches)
+            results.append({"name": "search_many_per_query", **entry,
+                            **{k: round(v / batch_size, 4) for k, v in timing.items()}})
+    return results
+
+
+def machine() -> dict:
+    """What the timings depend on besides the code."""
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+    }
+
+
+def result_key(result: dict) -> tuple:
+    return tuple((k, v) for k, v in result.items() if not k.endswith("_ms"))
+
+
+def previous_run(history: Path, host: dict):
+    """The most recent recorded run on the same machine, or None."""
+    if not history.exists():
+        return None
+    last = None
+    with open(history) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record.get("machine") == host:
+                    last = record
+    return last
+
+
+def compare(results: list, previous: dict, tolerance: float) -> list:
+    """Print each timing with its change vs `previous`; returns the regressions."""
+    before = {result_key(r): r["median_ms"] for r in previous["results"]} if previous else {}
+    regressions = []
+    for result in results:
+        label = " ".join(f"{k}={v}" for k, v in result_key(result))
+        line = f"  {label:<80} {result['median_ms']:>10.3f} ms"
+        old = before.get(result_key(result))
+        if old:
+            change = result["median_ms"] / old - 1
+            line += f"  {change:+7.1%}"
+            if change > tolerance:
+                line += "  REGRESSION"
+                regressions.append((label, old, result["median_ms"]))
+        print(line)
+    return regressions
+
+
+def parse_ints(value: str) -> tuple:
+    return tuple(int(v) for v in value.split(",") if v)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for search_server scoring")
+    parser.add_argument("--sizes", type=parse_ints, default=SIZES,
+                        help="Comma-separated corpus sizes in chunks")
+    parser.add_argument("--dims", type=parse_ints, default=DIMS,
+                        help="Comma-separated embedding dimensions (256-3072)")
+    parser.add_argument("--top-k", type=parse_ints, default=TOP_KS,
+                        help="Comma-separated top_k values")
+    parser.add_argument("--precisions", default=",".join(PRECISIONS),
+                        help=f"Comma-separated scoring precisions ({', '.join(PRECISIONS)})")
+    parser.add_argument("--queries", type=int, default=QUERIES,
+                        help="Timed queries per configuration")
+    parser.add_argument("--work-dir", type=Path, default=WORK_DIR,
+                        help="Where synthetic corpora are kept")
+    parser.add_argument("--history", type=Path, default=HISTORY_PATH,
+                        help="History file; one JSON line is appended per run")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="Median slowdown vs the previous run reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="Exit with status 1 if any timing regressed")
+    parser.add_argument("--no-record", action="store_true",
+                        help="Compare against the history without appending to it")
+    parser.add_argument("--label", default="", help="Free-form note stored with the results")
+    args = parser.parse_args()
+
+    precisions = tuple(p for p in args.precisions.split(",") if p)
+    unknown = set(precisions) - set(PRECISIONS)
+    if unknown:
+        parser.error(f"unknown precision(s): {', '.join(sorted(unknown))}")
+    if args.queries <= WARMUP:
+        parser.error(f"--queries must be more than {WARMUP}")
+
+    results = []
+    for size in args.sizes:
+        for dim in args.dims:
+            print(f"Benchmarking {size} chunks x {dim} dimensions ...")
+            results += bench_corpus(size, dim, args.top_k, precisions, args.queries,
+                                    args.work_dir)
+
+    host = machine()
+    previous = previous_run(args.history, host)
+    print(f"\nResults (median; change vs {previous['commit'] if previous else 'no previous run'}):")
+    regressions = compare(results, previous, args.tolerance)
+
+    if not args.no_record:
+        record = {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            **git_revision(),
+            "label": args.label,
+            "machine": host,
+            "results": results,
+        }
+        args.history.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.history, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        print(f"\nAppended results to {args.history}")
+
+    if regressions:
+        print(f"{len(regressions)} timing(s) regressed by more than {args.tolerance:.0%}")
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
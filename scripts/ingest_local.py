@@ -284,16 +284,20 @@ def detect_source(filepath: Path) -> str:
     return "UNKNOWN"
 
 
+# Citation patterns per source (also used by search_server's citation index)
+SECTION_ID_PATTERNS = {
+    "TCA36": r"(?:T\.?C\.?A\.?\s*)?§?\s*36-\d+-\d+(?:\([a-z]\))?",
+    "TCA37": r"(?:T\.?C\.?A\.?\s*)?§?\s*37-\d+-\d+(?:\([a-z]\))?",
+    "DCS": r"(?:DCS\s*)?(?:Policy\s*)?§?\s*\d+\.\d+",
+    "TRJPP": r"(?:TRJPP\s*)?Rule\s*\d+(?:\([a-z]\))?",
+    "LOCAL": r"(?:Local\s*)?Rule\s*\d+\.\d+",
+}
+DEFAULT_SECTION_ID_PATTERN = r"§?\s*\d+[\.-]\d+"
+
+
 def extract_section_id(text: str, source: str) -> str:
     """Extract legal section identifiers from text."""
-    patterns = {
-        "TCA36": r"(?:T\.?C\.?A\.?\s*)?§?\s*36-\d+-\d+(?:\([a-z]\))?",
-        "TCA37": r"(?:T\.?C\.?A\.?\s*)?§?\s*37-\d+-\d+(?:\([a-z]\))?",
-        "DCS": r"(?:DCS\s*)?(?:Policy\s*)?§?\s*\d+\.\d+",
-        "TRJPP": r"(?:TRJPP\s*)?Rule\s*\d+(?:\([a-z]\))?",
-        "LOCAL": r"(?:Local\s*)?Rule\s*\d+\.\d+",
-    }
-    pattern = patterns.get(source, r"§?\s*\d+[\.-]\d+")
+    pattern = SECTION_ID_PATTERNS.get(source, DEFAULT_SECTION_ID_PATTERN)
     match = re.search(pattern, text[:2000], re.IGNORECASE)
     return match.group(0).strip() if match else "GENERAL"
 
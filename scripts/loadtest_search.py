@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+"""
+Load test for the local vector search server.
+
+Generates a synthetic corpus of the requested size, starts search_server.py
+against a local fake of the OpenAI embeddings endpoint (with injected
+latency), drives POST /search at a fixed concurrency or request rate, and
+reports throughput and p50/p95/p99 latency. Each run appends one JSON line
+to the results file, tagged with the git commit, so runs can be compared
+across commits.
+
+Usage:
+    python3 scripts/loadtest_search.py
+    python3 scripts/loadtest_search.py --chunks 1000000 --dim 256 --concurrency 32
+    python3 scripts/loadtest_search.py --rate 200 --embed-latency 80 --server-args "--workers 4"
+    python3 scripts/loadtest_search.py --server http://127.0.0.1:8765   # existing server
+    python3 scripts/loadtest_search.py --transport both   # TCP vs Unix domain socket
+
+Needs no API key: the fake embeddings endpoint returns deterministic
+vectors derived from each input text.
+"""
+
+import argparse
+import hashlib
+import http.client
+import itertools
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from search_server import EMBEDDING_DIM, HOST, PROJECT_ROOT
+
+SERVER_SCRIPT = Path(__file__).resolve().parent / "search_server.py"
+WORK_DIR = Path(tempfile.gettempdir()) / "benchbook-loadtest"
+RESULTS_PATH = PROJECT_ROOT / "benchmarks" / "loadtest_search.jsonl"
+
+SERVER_PORT = 8865
+TRANSPORTS = ("tcp", "unix", "both")
+SOURCES = ("DCS", "LOCAL", "TCA36", "TCA37", "TRJPP")
+CHUNKS_PER_FILE = 40
+CHUNKS_PER_SECTION = 4
+VOCABULARY_SIZE = 5000
+WORDS_PER_CHUNK = 60
+WORDS_PER_QUERY = 6
+GENERATE_BLOCK_ROWS = 65536   # embedding rows generated and written at a time
+STARTUP_TIMEOUT = 1800.0      # seconds allowed for the server to load the corpus
+PERCENTILES = (50, 95, 99)
+
+
+# ---------------------------------------------------------------------------
+# Synthetic corpus
+# ---------------------------------------------------------------------------
+
+def vocabulary(size: int = VOCABULARY_SIZE) -> list[str]:
+    rng = random.Random(0)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choices(letters, k=rng.randint(3, 10))) for _ in range(size)]
+
+
+def synthetic_corpus(chunks: int, dim: int, work_dir: Path = WORK_DIR, seed: int = 0) -> Path:
+    """Write (or reuse) a corpus of `chunks` chunks with `dim`-dimensional embeddings.
+
+    Metadata goes to JSON and embeddings to the `.embeddings.npy` file that
+    load_chunks() reads, which keeps million-chunk corpora loadable.
+    """
+    path = work_dir / f"synthetic-{chunks}x{dim}-{seed}.json"
+    if path.exists():
+        return path
+    work_dir.mkdir(parents=True, exist_ok=True)
+    print(f"Generating a {chunks}-chunk, {dim}-dimension synthetic corpus in {work_dir} ...")
+    start = time.perf_counter()
+
+    rng = np.random.default_rng(seed)
+    vectors_path = path.with_suffix(".embeddings.npy")
+    vectors = np.lib.format.open_memmap(vectors_path.with_name(vectors_path.name + ".tmp"),
+                                        mode="w+", dtype=np.float32, shape=(chunks, dim))
+    for offset in range(0, chunks, GENERATE_BLOCK_ROWS):
+        rows = min(GENERATE_BLOCK_ROWS, chunks - offset)
+        vectors[offset:offset + rows] = rng.standard_normal((rows, dim), dtype=np.float32)
+    vectors.flush()
+    del vectors
+    os.replace(vectors_path.with_name(vectors_path.name + ".tmp"), vectors_path)
+
+    words = vocabulary()
+    text_rng = random.Random(seed)
+    metadata = []
+    for i in range(chunks):
+        source = SOURCES[i * len(SOURCES) // chunks]
+        doc, chunk_index = divmod(i, CHUNKS_PER_FILE)
+        metadata.append({
+            "id": f"syn_{i}",
+            "text": " ".join(text_rng.choices(words, k=WORDS_PER_CHUNK)),
+            "source": source,
+            "title": f"{source} document {doc}",
+            "section_id": f"{doc}.{chunk_index // CHUNKS_PER_SECTION}",
+            "file_path": f"{source.lower()}/doc{doc:07d}.txt",
+            "chunk_index": chunk_index,
+        })
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(metadata, f)
+    os.replace(tmp, path)
+    print(f"Generated in {time.perf_counter() - start:.1f}s")
+    return path
+
+
+def synthetic_queries(count: int, seed: int = 1) -> list[str]:
+    rng = random.Random(seed)
+    words = vocabulary()
+    return [" ".join(rng.choices(words, k=WORDS_PER_QUERY)) for _ in range(count)]
+
+
+# ---------------------------------------------------------------------------
+# Fake embeddings API
+# ---------------------------------------------------------------------------
+
+class FakeEmbeddingsHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible /v1/embeddings returning a fixed vector per input text.
+
+    Each response is delayed by `latency` seconds plus up to `jitter`
+    seconds, uniformly distributed, to stand in for the real API.
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    disable_nagle_algorithm = True  # no delayed-ACK stalls beyond the injected latency
+    dim = EMBEDDING_DIM
+    latency = 0.0
+    jitter = 0.0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        texts = json.loads(body)["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        data = [{"object": "embedding", "index": i, "embedding": self.vector(text)}
+                for i, text in enumerate(texts)]
+        out = json.dumps({"object": "list", "data": data}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    @classmethod
+    def vector(cls, text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        vec = np.random.default_rng(seed).standard_normal(cls.dim, dtype=np.float32)
+        return (vec / np.linalg.norm(vec)).round(6).tolist()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_embeddings(dim: int, latency: float, jitter: float) -> ThreadingHTTPServer:
+    FakeEmbeddingsHandler.dim = dim
+    FakeEmbeddingsHandler.latency = latency
+    FakeEmbeddingsHandler.jitter = jitter
+    server = ThreadingHTTPServer((HOST, 0), FakeEmbeddingsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-embeddings", daemon=True).start()
+    return server
+
+
+# ---------------------------------------------------------------------------
+# Server under test
+# ---------------------------------------------------------------------------
+
+def start_search_server(corpus: Path, embedding_url: str, port: int, extra_args: list,
+                        log_path: Path) -> subprocess.Popen:
+    env = dict(os.environ, OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "loadtest"))
+    cmd = [sys.executable, str(SERVER_SCRIPT), "--corpus", str(corpus), "--port", str(port),
+           "--embedding-url", embedding_url, *extra_args]
+    print(f"Starting {' '.join(shlex.quote(part) for part in cmd)}")
+    log = open(log_path, "w")
+    return subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+
+
+def wait_for_health(url: str, process: subprocess.Popen = None,
+                    timeout: float = STARTUP_TIMEOUT) -> dict:
+    """Poll GET /health until the server answers; returns the health document."""
+    parts = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"search server exited with {process.returncode}")
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=5)
+            conn.request("GET", "/health")
+            resp = conn.getresponse()
+            data = resp.read()
+            conn.close()
+            if resp.status == 200:
+                return json.loads(data)
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"search server at {url} not healthy after {timeout:.0f}s")
+
+
+# ---------------------------------------------------------------------------
+# Load generation
+# ---------------------------------------------------------------------------
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """http.client connection to a server's --unix-socket."""
+
+    def __init__(self, socket_path: str, timeout: float = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class LoadGenerator:
+    """Send /search requests from `concurrency` threads, each on its own connection.
+
+    With `rate` > 0 requests follow a fixed open-loop schedule and latency
+    is measured from each request's scheduled start, so time spent waiting
+    behind a slow server counts against it (no coordinated omission).
+    With `rate` 0 each thread sends its next request as soon as the last
+    one returns. With `unix_socket`, requests go to that socket instead of
+    the URL's host and port.
+    """
+
+    def __init__(self, url: str, queries: list[str], concurrency: int, rate: float = 0.0,
+                 top_k: int = 5, timeout: float = 30.0, unix_socket: Path = None):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.unix_socket = unix_socket
+        self.queries = queries
+        self.concurrency = concurrency
+        self.rate = rate
+        self.top_k = top_k
+        self.timeout = timeout
+        self.samples = []  # (start, latency seconds, status)
+        self._lock = threading.Lock()
+
+    def _worker(self, start: float, stop: float, ticket) -> None:
+        if self.unix_socket is not None:
+            conn = UnixHTTPConnection(str(self.unix_socket), timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        rng = random.Random(threading.get_ident())
+        samples = []
+        while True:
+            if self.rate > 0:
+                scheduled = start + next(ticket) / self.rate
+                if scheduled >= stop:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                scheduled = time.perf_counter()
+                if scheduled >= stop:
+                    break
+            body = json.dumps({"query": rng.choice(self.queries), "top_k": self.top_k})
+            try:
+                conn.request("POST", "/search", body=body,
+                             headers={"Content-Type": "application/json"})
+                resp = conn.getresponse()
+                resp.read()
+                status = resp.status
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                status = type(e).__name__
+            samples.append((scheduled, time.perf_counter() - scheduled, status))
+        conn.close()
+        with self._lock:
+            self.samples.extend(samples)
+
+    def run(self, duration: float) -> float:
+        """Generate load for `duration` seconds; returns the start time of the run."""
+        start = time.perf_counter()
+        ticket = itertools.count()  # next() is atomic under the GIL
+        threads = [threading.Thread(target=self._worker, args=(start, start + duration, ticket),
+                                    daemon=True)
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return start
+
+
+def summarize(samples: list, start: float, warmup: float, duration: float) -> dict:
+    """Throughput, status counts and latency percentiles of the post-warmup samples."""
+    measured = [s for s in samples if s[0] >= start + warmup]
+    window = duration - warmup
+    ok = np.array([latency for _, latency, status in measured if status == 200])
+    statuses = {}
+    for _, _, status in measured:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    latency_ms = {}
+    if len(ok):
+        latency_ms = {f"p{p}": round(float(np.percentile(ok, p)) * 1000, 3) for p in PERCENTILES}
+        latency_ms["mean"] = round(float(ok.mean()) * 1000, 3)
+        latency_ms["max"] = round(float(ok.max()) * 1000, 3)
+    return {
+        "requests": len(measured),
+        "statuses": statuses,
+        "error_rate": round(1 - len(ok) / len(measured), 4) if measured else None,
+        "throughput_rps": round(len(ok) / window, 2),
+        "latency_ms": latency_ms,
+    }
+
+
+def git_revision() -> dict:
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=PROJECT_ROOT, capture_output=True,
+                              text=True).stdout.strip()
+    try:
+        return {"commit": git("rev-parse", "--short", "HEAD") or None,
+                "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+    except OSError:
+        return {"commit": None, "dirty": None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the BenchBook AI search server")
+    parser.add_argument("--chunks", type=int, default=10000,
+                        help="Synthetic corpus size (1K to 1M chunks)")
+    parser.add_argument("--dim", type=int, default=EMBEDDING_DIM,
+                        help="Embedding dimensions of the synthetic corpus")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Client threads, each with its own connection")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Target requests/second (open loop); 0 sends back-to-back")
+    parser.add_argument("--duration", type=float, default=30.0,
+                        help="Seconds of load, including warmup")
+    parser.add_argument("--warmup", type=float, default=5.0,
+                        help="Initial seconds excluded from the results")
+    parser.add_argument("--top-k", type=int, default=5, help="top_k sent with each search")
+    parser.add_argument("--queries", type=int, default=1000,
+                        help="Distinct query texts to draw from (fewer means more cache hits)")
+    parser.add_argument("--embed-latency", type=float, default=50.0,
+                        help="Milliseconds the fake embeddings API waits before answering")
+    parser.add_argument("--embed-jitter", type=float, default=0.0,
+                        help="Extra random 0..N milliseconds added to each embeddings call")
+    parser.add_argument("--server", default=None,
+                        help="Test an already running server at this URL instead of starting one")
+    parser.add_argument("--server-args", default="",
+                        help="Extra search_server.py arguments, e.g. \"--workers 4 --ann ivf\"")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="tcp",
+                        help="Send searches over TCP, the server's Unix domain socket, or "
+                             "both in turn for a comparison")
+    parser.add_argument("--unix-socket", type=Path, default=None,
+                        help="Socket of an already running server (with --server); "
+                             "default: one in --work-dir for a server started here")
+    parser.add_argument("--port", type=int, default=SERVER_PORT,
+                        help="Port for the search server started by this script")
+    parser.add_argument("--work-dir", type=Path, default=WORK_DIR,
+                        help="Where synthetic corpora and server logs are kept")
+    parser.add_argument("--out", type=Path, default=RESULTS_PATH,
+                        help="Results file; one JSON line is appended per run")
+    parser.add_argument("--label", default="", help="Free-form note stored with the results")
+    args = parser.parse_args()
+    if not 0 <= args.warmup < args.duration:
+        parser.error("--warmup must be shorter than --duration")
+    transports = ("tcp", "unix") if args.transport == "both" else (args.transport,)
+    if args.server and "unix" in transports and args.unix_socket is None:
+        parser.error("--transport unix/both with --server needs the server's --unix-socket")
+
+    process = None
+    fake = None
+    runs = {}
+    try:
+        unix_socket = args.unix_socket
+        if args.server:
+            url = args.server.rstrip("/")
+        else:
+            corpus = synthetic_corpus(args.chunks, args.dim, args.work_dir)
+            fake = start_fake_embeddings(args.dim, args.embed_latency / 1000,
+                                         args.embed_jitter / 1000)
+            embedding_url = f"http://{HOST}:{fake.server_address[1]}/v1/embeddings"
+            log_path = args.work_dir / "search_server.log"
+            server_args = shlex.split(args.server_args)
+            if "unix" in transports:
+                unix_socket = unix_socket or args.work_dir / "search.sock"
+                server_args += ["--unix-socket", str(unix_socket)]
+            process = start_search_server(corpus, embedding_url, args.port, server_args,
+                                          log_path)
+            url = f"http://{HOST}:{args.port}"
+            print(f"Waiting for the server to load the corpus (log: {log_path}) ...")
+        health = wait_for_health(url, process)
+
+        mode = f"{args.rate:g} req/s" if args.rate > 0 else "closed loop"
+        queries = synthetic_queries(args.queries)
+        for transport in transports:
+            socket_path = unix_socket if transport == "unix" else None
+            target = f"unix:{socket_path}:" if socket_path is not None else url
+            print(f"Driving {target}/search for {args.duration:g}s: "
+                  f"{args.concurrency} connections, {mode}")
+            generator = LoadGenerator(url, queries, args.concurrency, rate=args.rate,
+                                      top_k=args.top_k, unix_socket=socket_path)
+            start = generator.run(args.duration)
+            runs[transport] = summarize(generator.samples, start, args.warmup, args.duration)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if fake is not None:
+            fake.shutdown()
+
+    records = []
+    for transport, results in runs.items():
+        latency = results["latency_ms"]
+        print(f"\n[{transport}] {results['requests']} requests, "
+              f"{results['throughput_rps']} req/s, statuses {results['statuses']}")
+        if latency:
+            print("latency ms: " + ", ".join(f"{name} {value}"
+                                             for name, value in latency.items()))
+        records.append({
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            **git_revision(),
+            "label": args.label,
+            "config": {
+                "chunks": health.get("chunks"),
+                "dim": args.dim if not args.server else None,
+                "transport": transport,
+                "concurrency": args.concurrency,
+                "rate": args.rate,
+                "duration": args.duration,
+                "warmup": args.warmup,
+                "top_k": args.top_k,
+                "queries": args.queries,
+                "embed_latency_ms": None if args.server else args.embed_latency,
+                "embed_jitter_ms": None if args.server else args.embed_jitter,
+                "server_args": args.server_args if not args.server else None,
+            },
+            "results": results,
+        })
+    if len(runs) == 2 and runs["tcp"]["latency_ms"] and runs["unix"]["latency_ms"]:
+        tcp, unix = runs["tcp"]["latency_ms"], runs["unix"]["latency_ms"]
+        print("\nunix vs tcp: " + ", ".join(
+            f"p{p} {unix[f'p{p}'] - tcp[f'p{p}']:+.3f} ms" for p in PERCENTILES))
+
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.out, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    print(f"Appended results to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
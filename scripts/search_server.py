@@ -6,19 +6,57 @@ over HTTP as a fallback when Pinecone is not configured.
 
 Usage:
     python3 scripts/search_server.py
+    python3 scripts/search_server.py --pool-size 16 --read-timeout 10
+    python3 scripts/search_server.py --spawn-shards 4   # coordinator + 4 local shards
+    python3 scripts/search_server.py --unix-socket /tmp/benchbook-search.sock
 
 Reads OPENAI_API_KEY from app/.env.local or .env.local in the project root.
-Listens on http://localhost:8765/search
+Listens on http://localhost:8765/search. The same port also answers the
+Pinecone data-plane API (/query, /vectors/upsert, /vectors/delete,
+/vectors/fetch, /describe_index_stats), so Pinecone clients can use it as
+an index host; upserts and deletes are refused unless --allow-writes.
 """
 
+import argparse
+import base64
+import bisect
+import gc
+import heapq
+import hmac
+import http.client
 import json
+import marshal
+import math
+import operator
 import os
+import queue
+import re
+import signal
+import socketserver
+import subprocess
 import sys
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from multiprocessing import shared_memory
 from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
 
 import numpy as np
 
+from ingest_local import CHUNK_OVERLAP, SECTION_ID_PATTERNS
+
+try:
+    import orjson  # optional: several times faster than json.dumps for result lists
+except ImportError:
+    orjson = None
+
 # Resolve paths relative to project root (parent of scripts/)
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 CHUNKS_PATH = PROJECT_ROOT / "legal-corpus" / "_processed" / "chunks_embedded.json"
@@ -27,119 +65,2972 @@ ENV_PATHS = [
     PROJECT_ROOT / ".env.local",
 ]
 
-HOST = "127.0.0.1"
-PORT = 8765
-TOP_K = 5
-EMBEDDING_MODEL = "text-embedding-3-large"
-EMBEDDING_DIM = 3072
+HOST = "127.0.0.1"
+PORT = 8765
+UNIX_SOCKET_MODE = 0o660    # owner and group may connect to --unix-socket
+UNIX_IDLE_TIMEOUT = 60.0    # seconds an idle keep-alive connection on the socket is kept
+TOP_K = 5
+MAX_TOP_K = 20
+MAX_BATCH_QUERIES = 32
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIM = 3072
+EMBEDDING_URL = "https://api.openai.com/v1/embeddings"
+
+# Keep-alive connection pool to the embeddings endpoint
+POOL_SIZE = 8            # max concurrent connections to the embeddings API
+CONNECT_TIMEOUT = 3.0    # seconds for TCP connect + TLS handshake
+READ_TIMEOUT = 20.0      # seconds to wait on a response from an open connection
+POOL_IDLE_TIMEOUT = 50.0 # drop idle connections before the server closes them
+POOL_KEEP_WARM = 1       # idle connections kept freshly open through quiet periods (0 = off)
+
+# Hedged embeddings calls
+EMBED_TIMEOUT = 8.0      # seconds an embeddings call may take, hedge included
+HEDGE_PERCENTILE = 95    # duplicate a call still running at this latency percentile (0 = off)
+HEDGE_MIN_DELAY = 0.05   # never hedge sooner than this many seconds
+HEDGE_WINDOW = 256       # recent call latencies the percentile is taken over
+HEDGE_MIN_SAMPLES = 20   # calls observed before hedging starts
+
+# Admission control, deadlines and the embeddings circuit breaker
+REQUEST_DEADLINE = 10.0  # seconds a search may take end to end (clients may ask for less)
+MAX_ACTIVE = 16          # searches processed at once
+MAX_QUEUED = 64          # searches waiting for a slot before new ones are refused with 503
+RETRY_AFTER = 1          # seconds suggested to clients refused because the queue is full
+BREAKER_FAILURES = 5     # consecutive embeddings failures that open the circuit
+BREAKER_RESET = 10.0     # seconds the circuit stays open before a trial request
+
+# Micro-batching of concurrent /search queries
+BATCH_WINDOW = 0.005     # seconds a batch stays open for more queries (0 disables batching)
+BATCH_MAX = 32           # queries per embeddings call and scoring pass
+
+# Approximate nearest neighbour (IVF) index
+ANN_NPROBE = 8           # inverted lists scanned per query
+ANN_KMEANS_ITERS = 20
+ANN_TRAIN_PER_LIST = 256 # k-means training sample size per centroid
+ANN_BLOCK_ROWS = 65536   # rows assigned per block to bound temporary memory
+
+# Reduced-precision scoring
+PRECISIONS = ("float32", "float16", "int8")
+QUANT_RESCORE = 4        # candidates re-scored in float32 per requested result
+QUANT_BLOCK_BYTES = 1 << 19  # float32 temporary per scoring block; small enough to stay in cache
+
+# Lexical (BM25) retrieval and hybrid fusion
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60               # reciprocal-rank fusion damping constant
+HYBRID_DEPTH = 100       # candidates taken from each ranker before fusion
+SEARCH_MODES = ("dense", "hybrid", "lexical")
+
+# Maximal Marginal Relevance diversification
+MMR_POOL = 50            # best sections re-ranked when diversity > 0
+
+# Section id that ingest_local gives chunks outside any numbered section
+GENERAL_SECTION = "GENERAL"
+
+# Citation fast path
+CITATION_MODES = ("auto", "blend", "off")
+CITATION_SECTION_SCORE = 1.0  # chunk belongs to the cited section
+CITATION_MENTION_SCORE = 0.5  # chunk text cites the section
+
+# Semantic query cache
+QUERY_CACHE_SIZE = 256          # recent query vectors kept (0 disables the cache)
+QUERY_CACHE_THRESHOLD = 0.97    # cosine similarity at which two queries share results
+
+# Scatter-gather across shard servers
+MERGE_FIELDS = ("source", "section_id", "file_path", "score")  # needed to merge shard results
+SHARD_STARTUP_POLL = 0.5  # seconds between health checks while spawned shards load
+
+# Response shaping
+RESULT_FIELDS = ("id", "text", "source", "title", "section_id", "file_path", "chunk_index", "score")
+DEFAULT_FIELDS = ("text", "source", "title", "section_id", "score")
+COMPRESS_MIN_BYTES = 1024  # smaller bodies are sent uncompressed
+COMPRESS_LEVEL = 5
+
+# Neighbouring-chunk context
+CONTEXT_MODES = ("neighbors", "stitch")
+MAX_CONTEXT_CHUNKS = 3   # chunks added on each side of a hit
+STITCH_MIN_OVERLAP = 20  # shortest repeated text treated as the ingest overlap when stitching
+
+# Pinecone-compatible data plane (/query, /vectors/*, /describe_index_stats)
+PINECONE_MAX_TOP_K = 10000   # Pinecone's own limit
+PINECONE_MAX_UPSERT = 1000   # vectors per upsert request
+PINECONE_MAX_FETCH = 1000    # ids per fetch request
+LIVE_APPLY_INTERVAL = 1.0    # seconds between folding queued upserts/deletes into the index
+WRITE_KEY_ENV = "SEARCH_WRITE_KEY"  # with --allow-writes, the Api-Key writes must send
+
+# On-demand profiling (/debug/profile, /debug/memory)
+DEBUG_TOKEN_ENV = "SEARCH_DEBUG_TOKEN"  # bearer token; the endpoints are off when unset
+PROFILE_INTERVAL = 0.005     # seconds between stack samples
+PROFILE_SECONDS = 10.0       # default profile length
+PROFILE_MAX_SECONDS = 300.0
+TRACEMALLOC_FRAMES = 8       # stack depth recorded per allocation
+
+# Latency histogram buckets (seconds), Prometheus style
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Hot reload
+RELOAD_INTERVAL = 5.0    # seconds between corpus file checks (0 disables polling)
+
+# Bump when the row order or on-disk layout of derived index files changes
+INDEX_FORMAT_VERSION = 2
+
+
+def load_env(path: Path) -> None:
+    """Load key=value pairs from a .env.local file into os.environ."""
+    if not path.exists():
+        return
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if "=" in line:
+                key, _, value = line.partition("=")
+                os.environ.setdefault(key.strip(), value.strip())
+
+
+def load_env_paths(paths: list[Path]) -> None:
+    """Load key=value pairs from multiple env files (first wins)."""
+    for path in paths:
+        load_env(path)
+
+
+def row_sort_key(chunk: dict):
+    """Row order for the matrix: grouped by source, then file, then position in file."""
+    return (chunk.get("source", ""), chunk.get("file_path", ""), chunk.get("chunk_index", 0))
+
+
+JSON_WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+
+
+def iter_json_array(path: Path):
+    """Yield the elements of the file's top-level JSON array one at a time.
+
+    Unlike json.load(), only the file's text and the current element are
+    held, never the whole parsed list.
+    """
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        text = f.read()
+    pos = JSON_WHITESPACE_RE.match(text).end()
+    if text[pos:pos + 1] != "[":
+        raise ValueError(f"{path} does not hold a JSON array")
+    pos = JSON_WHITESPACE_RE.match(text, pos + 1).end()
+    if text[pos:pos + 1] == "]":
+        return
+    while True:
+        item, pos = decoder.raw_decode(text, pos)
+        yield item
+        pos = JSON_WHITESPACE_RE.match(text, pos).end()
+        if text[pos:pos + 1] == "]":
+            return
+        if text[pos:pos + 1] != ",":
+            raise ValueError(f"{path}: expected ',' or ']' at offset {pos}")
+        pos = JSON_WHITESPACE_RE.match(text, pos + 1).end()
+
+
+def load_chunks(path: Path, shard: tuple = None):
+    """Load chunks and separate metadata from embeddings matrix.
+
+    Embeddings are read from each chunk's "embedding" field or, when the
+    chunks have none, from a (chunks, dim) float32 array in
+    `<name>.embeddings.npy` next to the file; large synthetic corpora use
+    the latter. Reloads follow the JSON file, so write the array first.
+
+    With `shard` (index, count) only chunks whose section hashes to that
+    shard are kept. Membership is decided as each chunk is parsed, and only
+    the kept chunks' embeddings (or rows of the .npy file) become matrix
+    rows, so a shard server's memory follows its share of the corpus.
+    """
+    print(f"Loading chunks from {path} ...")
+    vectors_path = path.with_suffix(".embeddings.npy")
+    metadata = []
+    embeddings = []  # float32 rows, when the chunks carry their embeddings
+    rows = []  # positions in the file of the kept chunks
+    dim = 0
+    total = 0
+    for total, chunk in enumerate(iter_json_array(path), 1):
+        if "embedding" in chunk:
+            dim = len(chunk["embedding"])
+        if shard is not None and shard_of(chunk, shard[1]) != shard[0]:
+            continue
+        emb = chunk.pop("embedding", None)
+        if emb is not None:
+            embeddings.append(np.asarray(emb, dtype=np.float32))
+        metadata.append(chunk)
+        rows.append(total - 1)
+
+    # Keep each source and each file in a contiguous block of rows so metadata
+    # filters can score a slice of the matrix instead of the whole thing.
+    order = sorted(range(len(metadata)), key=lambda i: row_sort_key(metadata[i]))
+    metadata = [metadata[i] for i in order]
+    if total and not dim and vectors_path.exists():
+        vectors = np.load(vectors_path, mmap_mode="r")
+        if len(vectors) != total:
+            raise ValueError(f"{vectors_path} has {len(vectors)} rows for {total} chunks")
+        matrix = np.array(vectors[np.array(rows, dtype=np.int64)[order]], dtype=np.float32)
+    else:
+        if len(embeddings) != len(metadata):
+            raise ValueError(f"{path}: every chunk needs an 'embedding' (or write {vectors_path})")
+        matrix = np.empty((len(metadata), dim), dtype=np.float32)
+        for i, row in enumerate(order):
+            matrix[i] = embeddings[row]
+        del embeddings
+
+    # Pre-normalize rows for fast cosine similarity (dot product on unit vectors)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+
+    print(f"Loaded {len(metadata)} chunks, embedding matrix shape: {matrix.shape}")
+    return metadata, matrix
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self) -> float:
+        """Sum over all label sets."""
+        with self._lock:
+            return sum(self._values.values())
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, **labels) -> _Timer:
+        """Context manager that observes the elapsed wall time of its block."""
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time."""
+
+    def __init__(self, name: str, help_text: str, read):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge",
+                f"{self.name} {self.read()}"]
+
+
+def _format_labels(key: tuple) -> str:
+    if not key:
+        return ""
+    parts = ",".join(f'{k}="{v}"' for k, v in key)
+    return "{" + parts + "}"
+
+
+def resident_memory_bytes() -> int:
+    """Current resident set size (falls back to peak RSS where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+REQUESTS = Counter("search_requests_total", "HTTP requests by endpoint and status")
+REQUEST_SECONDS = Histogram("search_request_seconds", "End-to-end request latency by endpoint")
+STAGE_SECONDS = Histogram("search_stage_seconds",
+                          "Latency of search stages (embed, score, select, dedup, serialize, ...)")
+EMBEDDING_ERRORS = Counter("search_embedding_errors_total", "Failed embeddings API calls by reason")
+HEDGES = Counter("search_embedding_hedges_total",
+                 "Duplicate embeddings calls sent for slow ones (issued) and how many answered "
+                 "first (won)")
+QUERY_CACHE = Counter("search_query_cache_total", "Semantic query cache lookups by result")
+BATCH_SIZE = Histogram("search_batch_size", "Queries per micro-batched embedding call",
+                       buckets=(1, 2, 4, 8, 16, 32, 64))
+COALESCED = Counter("search_coalesced_total",
+                    "Searches answered by an identical search already in flight")
+REJECTED = Counter("search_rejected_total",
+                   "Searches refused or abandoned by reason "
+                   "(queue_full, circuit_open, shard_busy, deadline)")
+SHARD_ERRORS = Counter("search_shard_errors_total", "Failed shard requests by shard and reason")
+
+
+class Overloaded(Exception):
+    """The request was refused to protect latency; answered with 503 and Retry-After."""
+
+    def __init__(self, message: str, retry_after: float, reason: str):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before it could be answered; answered with 504."""
+
+
+def time_left(deadline: float = None) -> float:
+    """Seconds until a time.monotonic() deadline (None if there is none).
+
+    Raises DeadlineExceeded once it has passed.
+    """
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("deadline exceeded")
+    return left
+
+
+class AdmissionControl:
+    """Bound the searches in progress and the queue waiting in front of them.
+
+    ThreadingHTTPServer starts a thread per connection; this caps how many
+    of them do work at once. Up to `max_queued` more wait for a slot until
+    their deadline, and anything beyond that is refused immediately, so a
+    load spike turns into fast 503s instead of unbounded queueing delay.
+    """
+
+    def __init__(self, max_active: int = MAX_ACTIVE, max_queued: int = MAX_QUEUED):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.active = 0
+        self.waiting = 0
+        self._slots = threading.BoundedSemaphore(max_active)
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline: float) -> None:
+        with self._lock:
+            if self.waiting >= self.max_queued:
+                raise Overloaded("Too many pending searches", RETRY_AFTER, "queue_full")
+            self.waiting += 1
+        try:
+            admitted = self._slots.acquire(timeout=max(deadline - time.monotonic(), 0))
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        if not admitted:
+            raise DeadlineExceeded("deadline exceeded while queued")
+        with self._lock:
+            self.active += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+
+class CircuitBreaker:
+    """Fail fast while a dependency is down.
+
+    After `threshold` consecutive failures the circuit opens and calls are
+    refused for `reset_timeout` seconds. Then a single trial call is let
+    through (half-open): success closes the circuit, failure re-opens it.
+    """
+
+    def __init__(self, threshold: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def before(self) -> bool:
+        """Raise Overloaded unless a call may go ahead now; True if it is the trial call."""
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            wait = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if wait > 0 or self._trial:
+                raise Overloaded("Embeddings API unavailable", max(wait, RETRY_AFTER),
+                                 "circuit_open")
+            self._trial = True
+            return True
+
+    def release_trial(self) -> None:
+        """End a trial call that gave no verdict on the API, so the next call is one."""
+        with self._lock:
+            self._trial = False
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class ConnectionPool:
+    """Bounded pool of persistent keep-alive HTTP(S) connections to one host.
+
+    At most `size` connections are checked out at once; callers beyond that
+    block until one is returned. Idle connections are reused LIFO so the
+    warmest socket serves the next request.
+    """
+
+    def __init__(self, url: str, size: int = POOL_SIZE,
+                 connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT,
+                 idle_timeout: float = POOL_IDLE_TIMEOUT):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported URL scheme: {url}")
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self._idle = queue.LifoQueue()  # (connection, last_used)
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = threading.Event()
+
+    def _connect(self, deadline: float = None) -> http.client.HTTPConnection:
+        """Open a new connection, applying the connect and read timeouts separately."""
+        timeout = self._cap(self.connect_timeout, deadline)
+        if self.scheme == "https":
+            conn = http.client.HTTPSConnection(self.host, self.port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    @staticmethod
+    def _cap(timeout: float, deadline: float = None) -> float:
+        """`timeout`, shortened to the time left before `deadline`."""
+        left = time_left(deadline)
+        return timeout if left is None else min(timeout, left)
+
+    def _checkout(self, deadline: float = None):
+        """Return (connection, reused), discarding idle connections that have gone stale."""
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect(deadline), False
+            if time.monotonic() - last_used < self.idle_timeout:
+                return conn, True
+            conn.close()
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None,
+                deadline: float = None):
+        """Send a request over a pooled connection and return (status, body bytes).
+
+        With a time.monotonic() `deadline`, waiting for a free connection,
+        connecting and each socket read are cut short when it passes.
+        """
+        if not self._slots.acquire(timeout=time_left(deadline)):
+            raise DeadlineExceeded(f"no connection to {self.host} free before the deadline")
+        try:
+            for attempt in range(2):
+                conn, reused = self._checkout(deadline)
+                try:
+                    conn.sock.settimeout(self._cap(self.read_timeout, deadline))
+                    conn.request(method, path, body=body, headers=headers or {})
+                    resp = conn.getresponse()
+                    data = resp.read()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    # A reused keep-alive socket may have been closed by the server
+                    # while idle; retry once on a fresh connection.
+                    if reused and attempt == 0:
+                        continue
+                    raise
+                except Exception:
+                    conn.close()
+                    raise
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self._idle.put((conn, time.monotonic()))
+                return resp.status, data
+        finally:
+            self._slots.release()
+
+    def warm_up(self, count: int = None) -> int:
+        """Open up to `count` connections ahead of time so no request pays the handshake."""
+        count = min(count or self.size, self.size)
+        opened = 0
+        for _ in range(count):
+            try:
+                conn = self._connect()
+            except OSError as e:
+                print(f"Warning: could not pre-connect to {self.host}: {e}", file=sys.stderr)
+                break
+            self._idle.put((conn, time.monotonic()))
+            opened += 1
+        return opened
+
+    def keep_warm(self, count: int = POOL_KEEP_WARM) -> threading.Thread:
+        """Keep `count` idle connections open in the background.
+
+        warm_up() alone only helps until its connections pass idle_timeout;
+        after that the first request following a quiet spell would pay the
+        TCP and TLS handshakes again. Every idle_timeout / 4 this replaces
+        idle connections older than idle_timeout / 2 and tops the pool up, so
+        no idle connection outlives idle_timeout.
+        """
+        def run():
+            while not self._closed.wait(self.idle_timeout / 4):
+                self.refresh(count)
+
+        thread = threading.Thread(target=run, name="pool-keep-warm", daemon=True)
+        thread.start()
+        return thread
+
+    def refresh(self, count: int) -> int:
+        """Close idle connections past idle_timeout / 2 and open new ones up to `count`.
+
+        Returns how many were opened.
+        """
+        horizon = time.monotonic() - self.idle_timeout / 2
+        fresh = []
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if last_used > horizon:
+                fresh.append((conn, last_used))
+            else:
+                conn.close()
+        opened = 0
+        while len(fresh) < count:
+            try:
+                conn = self._connect()
+            except OSError as e:
+                print(f"Warning: could not refresh connection to {self.host}: {e}",
+                      file=sys.stderr)
+                break
+            fresh.append((conn, time.monotonic()))
+            opened += 1
+        for item in sorted(fresh, key=lambda item: item[1]):  # newest on top of the LIFO
+            self._idle.put(item)
+        return opened
+
+    def close(self) -> None:
+        self._closed.set()
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+
+
+class LatencyWindow:
+    """Percentiles over the most recent `size` observed durations."""
+
+    def __init__(self, size: int = HEDGE_WINDOW, min_samples: int = HEDGE_MIN_SAMPLES):
+        self.samples = np.zeros(size)
+        self.min_samples = min_samples
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self.samples[self.count % len(self.samples)] = seconds
+            self.count += 1
+
+    def percentile(self, q: float):
+        """The q-th percentile in seconds, or None until `min_samples` were observed."""
+        with self._lock:
+            if self.count < self.min_samples:
+                return None
+            return float(np.percentile(self.samples[:min(self.count, len(self.samples))], q))
+
+
+class EmbeddingClient:
+    """OpenAI embeddings client that reuses pooled keep-alive connections.
+
+    Calls go through a circuit breaker: network errors, timeouts, HTTP 429
+    and 5xx count as failures, and while the circuit is open embed_many()
+    raises Overloaded without contacting the API.
+
+    A call still running once it is slower than `hedge_percentile` of recent
+    calls is hedged: the same request goes out on a second connection and
+    whichever answers first is used. Calls give up after `timeout` seconds.
+    """
+
+    def __init__(self, api_key: str, url: str = EMBEDDING_URL, pool_size: int = POOL_SIZE,
+                 connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT,
+                 breaker: CircuitBreaker = None, timeout: float = EMBED_TIMEOUT,
+                 hedge_percentile: float = HEDGE_PERCENTILE):
+        self.path = urlsplit(url).path or "/"
+        self.pool = ConnectionPool(url, size=pool_size, connect_timeout=connect_timeout,
+                                   read_timeout=read_timeout)
+        self.breaker = breaker or CircuitBreaker()
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.latency = LatencyWindow()
+        self._executor = (ThreadPoolExecutor(max_workers=2 * pool_size,
+                                             thread_name_prefix="embed")
+                          if hedge_percentile > 0 else None)
+
+    def hedge_delay(self):
+        """Seconds after which a call is hedged, or None (off, or too few calls seen yet)."""
+        if self._executor is None:
+            return None
+        delay = self.latency.percentile(self.hedge_percentile)
+        return None if delay is None else max(delay, HEDGE_MIN_DELAY)
+
+    def embed(self, text: str, deadline: float = None) -> np.ndarray:
+        """Call the embeddings API and return the unit-normalized query vector."""
+        return self.embed_many([text], deadline=deadline)[0]
+
+    def embed_many(self, texts: list[str], deadline: float = None) -> np.ndarray:
+        """Embed several texts in one API call; returns a (len(texts), dim) unit-row matrix.
+
+        `deadline` (time.monotonic()) bounds the whole call; DeadlineExceeded
+        is raised when it passes first.
+        """
+        req_body = json.dumps({
+            "model": EMBEDDING_MODEL,
+            "input": texts,
+            "dimensions": EMBEDDING_DIM,
+        }).encode()
+
+        limit = time.monotonic() + self.timeout
+        caller_deadline = deadline is not None and deadline < limit
+        deadline = limit if deadline is None else min(deadline, limit)
+        with STAGE_SECONDS.time(stage="embed"):
+            raw = self._hedged(req_body, deadline, caller_deadline)
+        data = json.loads(raw)
+
+        items = sorted(data["data"], key=lambda item: item.get("index", 0))
+        vecs = np.array([item["embedding"] for item in items], dtype=np.float32)
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vecs / norms
+
+
+    def _hedged(self, body: bytes, deadline: float, caller_deadline: bool = False) -> bytes:
+        """_call(), plus a duplicate if it outlasts hedge_delay(); the first success wins."""
+        delay = self.hedge_delay()
+        if delay is None:
+            return self._call(body, deadline, caller_deadline)
+        left = time_left(deadline)
+        first = self._executor.submit(self._call, body, deadline, caller_deadline)
+        try:
+            return first.result(timeout=min(delay, left))
+        except FutureTimeout:
+            if left <= delay:  # the deadline came first; a hedge could only be late
+                raise DeadlineExceeded("deadline exceeded waiting for embeddings") from None
+        HEDGES.inc(result="issued")
+        hedge = self._executor.submit(self._call, body, deadline, caller_deadline)
+        pending = {first, hedge}
+        while pending:
+            done, pending = wait(pending, timeout=time_left(deadline),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        HEDGES.inc(result="won")
+                    return future.result()
+                if not pending:
+                    raise future.exception()
+        raise DeadlineExceeded("deadline exceeded waiting for embeddings")
+
+    def _call(self, body: bytes, deadline: float, caller_deadline: bool = False) -> bytes:
+        """One embeddings API request; returns the response body or raises.
+
+        With `caller_deadline`, `deadline` is the request's own (shorter than
+        the embed timeout), so running out of it says nothing about the API.
+        """
+        trial = self.breaker.before()
+        start = time.monotonic()
+        try:
+            status, raw = self.pool.request("POST", self.path, body=body,
+                                            headers=self.headers, deadline=deadline)
+        except DeadlineExceeded:
+            # No connection was free or the deadline had passed: local
+            # congestion, not an API failure.
+            if trial:
+                self.breaker.release_trial()
+            raise
+        except Exception as e:
+            timed_out = isinstance(e, TimeoutError) and time.monotonic() >= deadline
+            if timed_out and caller_deadline:
+                if trial:
+                    self.breaker.release_trial()
+                raise DeadlineExceeded("deadline exceeded waiting for embeddings") from e
+            EMBEDDING_ERRORS.inc(reason=type(e).__name__)
+            self.breaker.failure()
+            if timed_out:
+                raise DeadlineExceeded("deadline exceeded waiting for embeddings") from e
+            raise
+        if status != 200:
+            EMBEDDING_ERRORS.inc(reason=f"http_{status}")
+            if status == 429 or status >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success()  # the API is up; the request itself was bad
+            raise RuntimeError(f"Embeddings API returned HTTP {status}: {raw[:200]!r}")
+        self.breaker.success()
+        self.latency.observe(time.monotonic() - start)
+        return raw
+
+
+def top_n(scores: np.ndarray, n: int) -> np.ndarray:
+    """Positions of the n highest scores, best first."""
+    n = min(n, len(scores))
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    if n < len(scores):
+        top = np.argpartition(scores, -n)[-n:]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(scores[top])[::-1]]
+
+
+def corpus_fingerprint(path: Path) -> str:
+    """Identify a corpus file version so derived index files can be reused safely."""
+    st = path.stat()
+    return f"v{INDEX_FORMAT_VERSION}-{st.st_size}-{st.st_mtime_ns}"
+
+
+class IVFIndex:
+    """Inverted-file ANN index over the normalized embedding matrix.
+
+    Spherical k-means centroids partition the rows; rows are stored as one
+    permutation with per-list offsets so each inverted list is a contiguous
+    slice. A query scores only the rows in its `nprobe` nearest lists.
+    """
+
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray,
+                 nprobe: int = ANN_NPROBE):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @staticmethod
+    def _assign(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """Nearest-centroid assignment, computed in row blocks."""
+        labels = np.empty(len(matrix), dtype=np.int32)
+        for start in range(0, len(matrix), ANN_BLOCK_ROWS):
+            block = matrix[start:start + ANN_BLOCK_ROWS]
+            labels[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return labels
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, nlist: int = None, nprobe: int = ANN_NPROBE,
+              iters: int = ANN_KMEANS_ITERS, seed: int = 0) -> "IVFIndex":
+        """Train centroids on a sample of rows, then bucket every row."""
+        n = len(matrix)
+        nlist = max(1, min(nlist or int(np.sqrt(n)), n))
+        rng = np.random.default_rng(seed)
+        sample_size = min(n, nlist * ANN_TRAIN_PER_LIST)
+        sample = matrix[rng.choice(n, sample_size, replace=False)] if sample_size < n else matrix
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+        for _ in range(iters):
+            labels = cls._assign(sample, centroids)
+            counts = np.bincount(labels, minlength=nlist)
+            # Per-cluster sums via one sort + reduceat (much faster than np.add.at)
+            grouped = sample[np.argsort(labels, kind="stable")]
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            sums = np.zeros_like(centroids)
+            nonempty = counts > 0
+            sums[nonempty] = np.add.reduceat(grouped, starts[nonempty], axis=0)
+            # Re-seed empty clusters from random sample rows
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        labels = cls._assign(matrix, centroids)
+        order = np.argsort(labels, kind="stable").astype(np.int64)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=nlist), out=offsets[1:])
+        return cls(centroids, order, offsets, nprobe=nprobe)
+
+    def save(self, path: Path, fingerprint: str) -> None:
+        with open(path, "wb") as f:
+            np.savez(f, centroids=self.centroids, order=self.order,
+                     offsets=self.offsets, fingerprint=np.array(fingerprint))
+
+    @classmethod
+    def load(cls, path: Path, fingerprint: str, nprobe: int = ANN_NPROBE):
+        """Load a precomputed index, or return None if missing or built from another corpus."""
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            if str(data["fingerprint"]) != fingerprint:
+                return None
+            return cls(data["centroids"], data["order"], data["offsets"], nprobe=nprobe)
+
+    def candidates(self, query_vec: np.ndarray, nprobe: int = None) -> np.ndarray:
+        """Row indices in the `nprobe` inverted lists closest to the query."""
+        nprobe = max(1, min(nprobe or self.nprobe, self.nlist))
+        centroid_scores = self.centroids @ query_vec
+        if nprobe < self.nlist:
+            probes = np.argpartition(centroid_scores, -nprobe)[-nprobe:]
+        else:
+            probes = np.arange(self.nlist)
+        return np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probes])
+
+    def search(self, query_vec: np.ndarray, matrix: np.ndarray, k: int, nprobe: int = None):
+        """Return (rows, scores) for the approximate top-k rows, best first."""
+        rows = self.candidates(query_vec, nprobe)
+        scores = matrix[rows] @ query_vec
+        top = top_n(scores, k)
+        return rows[top], scores[top]
+
+
+def load_or_build_ivf(matrix: np.ndarray, corpus_path: Path, nlist: int = None,
+                      nprobe: int = ANN_NPROBE, tag: str = "") -> IVFIndex:
+    """Reuse the precomputed IVF file next to the corpus, rebuilding it if stale.
+
+    `tag` distinguishes the files of different shards of one corpus.
+    """
+    index_path = corpus_path.with_suffix(f"{tag}.ivf.npz")
+    fingerprint = f"{corpus_fingerprint(corpus_path)}-{nlist or 'auto'}"
+    index = IVFIndex.load(index_path, fingerprint, nprobe=nprobe)
+    if index is not None:
+        print(f"Loaded IVF index from {index_path} ({index.nlist} lists)")
+        return index
+
+    start = time.perf_counter()
+    index = IVFIndex.build(matrix, nlist=nlist, nprobe=nprobe)
+    print(f"Built IVF index with {index.nlist} lists in {time.perf_counter() - start:.1f}s")
+    try:
+        index.save(index_path, fingerprint)
+    except OSError as e:
+        print(f"Warning: could not save IVF index to {index_path}: {e}", file=sys.stderr)
+    return index
+
+
+def ann_recall(index: IVFIndex, matrix: np.ndarray, k: int = 10, nprobe: int = None,
+               samples: int = 200, seed: int = 0) -> dict:
+    """Measure recall@k and latency of the IVF index against brute-force search.
+
+    Queries are perturbed corpus rows, which approximates real queries that
+    land near (but not exactly on) stored chunks.
+    """
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(matrix), min(samples, len(matrix)), replace=False)
+    queries = matrix[picks] + rng.normal(0, 0.02, (len(picks), matrix.shape[1])).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    k = min(k, len(matrix))
+
+    hits = 0
+    exact_time = ann_time = 0.0
+    for q in queries:
+        t0 = time.perf_counter()
+        scores = matrix @ q
+        truth = np.argpartition(scores, -k)[-k:]
+        t1 = time.perf_counter()
+        rows, _ = index.search(q, matrix, k, nprobe=nprobe)
+        t2 = time.perf_counter()
+        hits += len(np.intersect1d(truth, rows))
+        exact_time += t1 - t0
+        ann_time += t2 - t1
+
+    n = len(queries)
+    return {
+        "recall": hits / (n * k),
+        "k": k,
+        "nprobe": nprobe or index.nprobe,
+        "exact_ms": exact_time / n * 1000,
+        "ann_ms": ann_time / n * 1000,
+    }
+
+
+class QuantizedMatrix:
+    """Compact copy of the embedding matrix for approximate scoring.
+
+    float16 halves the matrix; int8 stores each row as round(row / scale)
+    with a per-row scale of max|row| / 127, a quarter of the size. Scoring
+    up-casts one cache-sized block of rows at a time, so the product reads
+    far less memory than a float32 scan (int8 scores faster than exact
+    float32; NumPy's float16 conversion is slow on most CPUs). The best
+    candidates are then re-scored against the float32 matrix, which is
+    memory-mapped from disk rather than held in RAM.
+    """
+
+    def __init__(self, precision: str, codes: np.ndarray, scales: np.ndarray = None):
+        self.precision = precision
+        self.codes = codes
+        self.scales = scales
+        self.recall = None  # filled in by quantized_recall() when checked
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def describe(self) -> dict:
+        return {
+            "dtype": self.precision,
+            "bytes": self.nbytes,
+            "resident_bytes": resident_memory_bytes(),
+            "recall": self.recall["recall"] if self.recall is not None else None,
+        }
+
+    @staticmethod
+    def _block_rows(dim: int) -> int:
+        return max(16, QUANT_BLOCK_BYTES // (4 * max(dim, 1)))
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, precision: str) -> "QuantizedMatrix":
+        if precision == "float16":
+            return cls(precision, matrix.astype(np.float16))
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.empty(matrix.shape, dtype=np.int8)
+        block = cls._block_rows(matrix.shape[1])
+        for lo in range(0, len(matrix), block):
+            hi = lo + block
+            codes[lo:hi] = np.rint(matrix[lo:hi] / scales[lo:hi, None])
+        return cls(precision, codes, scales.astype(np.float32))
+
+    def scores(self, queries: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        """Approximate scores of `rows` (all rows if None) for one query vector
+        (returns shape (rows,)) or a (queries, dim) matrix (returns (queries, rows))."""
+        codes = self.codes if rows is None else subset(self.codes, rows)
+        scales = None
+        if self.scales is not None:
+            scales = self.scales if rows is None else self.scales[rows]
+        qt = queries.T
+        out = np.empty((len(codes),) + qt.shape[1:], dtype=np.float32)
+        block = self._block_rows(codes.shape[1])
+        for lo in range(0, len(codes), block):
+            hi = lo + block
+            np.matmul(codes[lo:hi].astype(np.float32), qt, out=out[lo:hi])
+            if scales is not None:
+                out[lo:hi] *= scales[lo:hi].reshape((-1,) + (1,) * (qt.ndim - 1))
+        return out.T
+
+
+def rescore(query_vec: np.ndarray, matrix: np.ndarray, rows: np.ndarray, n: int):
+    """Exact top-n (rows, scores) among candidate rows of the float32 matrix."""
+    with STAGE_SECONDS.time(stage="rescore"):
+        order = np.argsort(rows)  # read the memory-mapped file front to back
+        exact = np.empty(len(rows), dtype=np.float32)
+        exact[order] = matrix[rows[order]] @ query_vec
+        top = top_n(exact, n)
+        return rows[top], exact[top]
+
+
+def memory_map_matrix(matrix: np.ndarray, corpus_path: Path, tag: str = "") -> np.ndarray:
+    """Write the float32 matrix to a file and return a read-only memory map of it.
+
+    Each call writes its own uniquely named file next to the corpus, or in
+    the temp directory when that is not writable, and unlinks it once mapped.
+    A reload and a batch of live writes therefore never share a file, and the
+    disk space is freed when the last snapshot mapping it is released. If
+    neither directory is writable the in-memory matrix is returned as is.
+    """
+    for directory in (corpus_path.parent, None):
+        try:
+            with tempfile.NamedTemporaryFile(dir=directory, prefix=f".{corpus_path.stem}{tag}.",
+                                             suffix=".f32.npy") as f:
+                np.save(f, matrix)
+                f.flush()
+                return np.load(f.name, mmap_mode="r")
+        except OSError as e:
+            print(f"Warning: could not write the float32 matrix to "
+                  f"{directory or tempfile.gettempdir()}: {e}", file=sys.stderr)
+    return matrix
+
+
+def quantized_recall(quantized: QuantizedMatrix, matrix: np.ndarray, k: int = 10,
+                     samples: int = 200, seed: int = 0) -> dict:
+    """Measure recall@k of quantized scoring plus exact re-rank against float32 brute force.
+
+    Queries are perturbed corpus rows, as in ann_recall().
+    """
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(matrix), min(samples, len(matrix)), replace=False)
+    queries = matrix[picks] + rng.normal(0, 0.02, (len(picks), matrix.shape[1])).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    k = min(k, len(matrix))
+
+    hits = 0
+    exact_time = quant_time = 0.0
+    for q in queries:
+        t0 = time.perf_counter()
+        truth = top_n(matrix @ q, k)
+        t1 = time.perf_counter()
+        candidates = top_n(quantized.scores(q), k * QUANT_RESCORE)
+        rows, _ = rescore(q, matrix, candidates, k)
+        t2 = time.perf_counter()
+        hits += len(np.intersect1d(truth, rows))
+        exact_time += t1 - t0
+        quant_time += t2 - t1
+
+    n = len(queries)
+    return {
+        "recall": hits / (n * k),
+        "k": k,
+        "exact_ms": exact_time / n * 1000,
+        "quantized_ms": quant_time / n * 1000,
+    }
+
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have if in is it its of on or shall "
+    "that the this to was were which with".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase word tokens; citations like 37-1-114 and 14.12 stay whole."""
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+class BM25Index:
+    """Compact in-memory inverted index with precomputed BM25 weights.
+
+    Postings are stored CSR-style: the documents for term `t` are
+    doc_ids[indptr[t]:indptr[t + 1]], with the matching BM25 contribution
+    (idf x saturated tf) in `weights`. Query scoring is one scatter-add per
+    query term.
+    """
+
+    def __init__(self, terms: np.ndarray, indptr: np.ndarray, doc_ids: np.ndarray,
+                 weights: np.ndarray, n_docs: int):
+        self.terms = terms
+        self.vocab = {term: i for i, term in enumerate(terms.tolist())}
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, texts: list[str], k1: float = BM25_K1, b: float = BM25_B) -> "BM25Index":
+        vocab = {}
+        term_ids = []
+        doc_ids = []
+        doc_lens = np.zeros(len(texts), dtype=np.float32)
+        for doc, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lens[doc] = len(tokens)
+            term_ids.extend(vocab.setdefault(t, len(vocab)) for t in tokens)
+            doc_ids.extend([doc] * len(tokens))
+
+        n_docs = len(texts)
+        term_ids = np.array(term_ids, dtype=np.int64)
+        doc_ids = np.array(doc_ids, dtype=np.int64)
+        # One (term, doc) posting per unique pair; its count is the term frequency.
+        keys, tf = np.unique(term_ids * max(n_docs, 1) + doc_ids, return_counts=True)
+        post_terms = keys // max(n_docs, 1)
+        post_docs = keys % max(n_docs, 1)
+
+        df = np.bincount(post_terms, minlength=len(vocab)).astype(np.float32)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+        avgdl = float(doc_lens.mean()) if n_docs else 0.0
+        norm = k1 * (1 - b + b * doc_lens[post_docs] / max(avgdl, 1e-9))
+        weights = (idf[post_terms] * tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df.astype(np.int64), out=indptr[1:])
+        terms = np.array(list(vocab), dtype=str)
+        return cls(terms, indptr, post_docs.astype(np.int32), weights, n_docs)
+
+    def save(self, path: Path, fingerprint: str) -> None:
+        with open(path, "wb") as f:
+            np.savez(f, terms=self.terms, indptr=self.indptr, doc_ids=self.doc_ids,
+                     weights=self.weights, n_docs=np.array(self.n_docs),
+                     fingerprint=np.array(fingerprint))
+
+    @classmethod
+    def load(cls, path: Path, fingerprint: str):
+        """Load a serialized index, or return None if missing or built from another corpus."""
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            if str(data["fingerprint"]) != fingerprint:
+                return None
+            return cls(data["terms"], data["indptr"], data["doc_ids"], data["weights"],
+                       int(data["n_docs"]))
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every document for the query (zeros where no term matches)."""
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            t = self.vocab.get(term)
+            if t is None:
+                continue
+            lo, hi = self.indptr[t], self.indptr[t + 1]
+            # Each document appears at most once per term, so fancy += is safe
+            scores[self.doc_ids[lo:hi]] += self.weights[lo:hi]
+        return scores
+
+
+def load_or_build_bm25(metadata: list, corpus_path: Path, tag: str = "") -> BM25Index:
+    """Reuse the serialized BM25 index next to the corpus, rebuilding it if stale."""
+    index_path = corpus_path.with_suffix(f"{tag}.bm25.npz")
+    fingerprint = f"{corpus_fingerprint(corpus_path)}-{BM25_K1}-{BM25_B}"
+    index = BM25Index.load(index_path, fingerprint)
+    if index is not None:
+        print(f"Loaded BM25 index from {index_path} ({len(index.terms)} terms)")
+        return index
+
+    start = time.perf_counter()
+    index = BM25Index.build([chunk.get("text", "") for chunk in metadata])
+    print(f"Built BM25 index with {len(index.terms)} terms in {time.perf_counter() - start:.1f}s")
+    try:
+        index.save(index_path, fingerprint)
+    except OSError as e:
+        print(f"Warning: could not save BM25 index to {index_path}: {e}", file=sys.stderr)
+    return index
+
+
+# Citation shapes recognised in queries and chunk text. The per-source
+# patterns come from ingest_local so query citations normalize the same way
+# as stored section IDs; the first entry generalizes its TCA patterns to
+# any title.
+CITATION_PATTERNS = [re.compile(p, re.IGNORECASE) for p in (
+    r"(?:T\.?C\.?A\.?\s*)?§?\s*\d+-\d+-\d+(?:\([a-z]\))?",
+    SECTION_ID_PATTERNS["LOCAL"],
+    SECTION_ID_PATTERNS["TRJPP"],
+    SECTION_ID_PATTERNS["DCS"],
+)]
+# Words and punctuation that may surround a citation in a "bare citation" query
+CITATION_FILLER_RE = re.compile(
+    r"\b(?:tenn|code|ann|tca|section|sec|dcs|policy|trjpp|local|rule|see)\b|[^a-z0-9]",
+    re.IGNORECASE,
+)
+
+
+# Citations inside chunk text: explicit forms only, so stray decimals such
+# as "2.5 hours" are not indexed as DCS policies.
+MENTION_RE = re.compile(r"\d+-\d+-\d+|rule\s*\d+(?:\.\d+)?|(?:policy|dcs)\s*\d+\.\d+",
+                        re.IGNORECASE)
+
+
+def citation_key(text: str):
+    """Normalize a citation to a lookup key such as '37-1-117', 'rule 206' or 'policy 14.12'."""
+    t = text.lower()
+    m = re.search(r"\d+-\d+-\d+", t)
+    if m:
+        return m.group(0)
+    m = re.search(r"rule\s*(\d+(?:\.\d+)?)", t)
+    if m:
+        return f"rule {m.group(1)}"
+    m = re.search(r"\d+\.\d+", t)
+    if m:
+        return f"policy {m.group(0)}"
+    return None
+
+
+def citation_key_prefixes(prefix: str) -> list:
+    """citation_key() prefixes for a partial citation such as '14.' or 'T.C.A. § 37-1-'.
+
+    A bare number may begin a DCS policy or a statute, so it yields both.
+    """
+    t = prefix.lower()
+    m = re.search(r"\d+-[\d-]*", t)
+    if m:
+        return [m.group(0)]
+    m = re.search(r"rule\s*(\d[\d.]*)?", t)
+    if m:
+        return [f"rule {m.group(1) or ''}"]
+    m = re.search(r"\d+\.\d*", t)
+    if m:
+        return [f"policy {m.group(0)}"]
+    m = re.search(r"\d+", t)
+    if m:
+        return [f"policy {m.group(0)}", m.group(0)]
+    return []
+
+
+def find_citations(text: str):
+    """Return (keys in order of appearance, text with the citations removed)."""
+    spans = []
+    for pattern in CITATION_PATTERNS:
+        for m in pattern.finditer(text):
+            if any(m.start() < end and start < m.end() for start, end, _ in spans):
+                continue
+            key = citation_key(m.group(0))
+            if key:
+                spans.append((m.start(), m.end(), key))
+    spans.sort()
+    keys = list(dict.fromkeys(key for _, _, key in spans))
+    residue = text
+    for start, end, _ in reversed(spans):
+        residue = residue[:start] + " " + residue[end:]
+    return keys, residue
+
+
+class CitationIndex:
+    """Map normalized citations to rows: chunks of the cited section, then chunks citing it."""
+
+    def __init__(self, metadata: list):
+        sections = {}
+        mentions = {}
+        for row, chunk in enumerate(metadata):
+            key = citation_key(str(chunk.get("section_id", "")))
+            if key:
+                sections.setdefault(key, []).append(row)
+            cited_keys = {citation_key(m.group(0)) for m in MENTION_RE.finditer(chunk.get("text", ""))}
+            for cited in cited_keys:
+                if cited != key:
+                    mentions.setdefault(cited, []).append(row)
+        self.sections = {k: np.array(v, dtype=np.int64) for k, v in sections.items()}
+        self.mentions = {k: np.array(v, dtype=np.int64) for k, v in mentions.items()}
+
+    def lookup(self, keys: list, rows: np.ndarray = None):
+        """Return (rows, scores) for the cited sections, optionally limited to filtered rows."""
+        hit_rows = []
+        hit_scores = []
+        for table, score in ((self.sections, CITATION_SECTION_SCORE),
+                             (self.mentions, CITATION_MENTION_SCORE)):
+            for key in keys:
+                found = table.get(key)
+                if found is None:
+                    continue
+                if rows is not None:
+                    found = found[np.isin(found, rows, assume_unique=True)]
+                hit_rows.append(found)
+                hit_scores.append(np.full(len(found), score, dtype=np.float32))
+        if not hit_rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return np.concatenate(hit_rows), np.concatenate(hit_scores)
+
+    def match(self, query: str, rows: np.ndarray = None):
+        """Look up citations in a query; returns (rows, scores, is_bare_citation)."""
+        keys, residue = find_citations(query)
+        if not keys:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), False
+        found_rows, found_scores = self.lookup(keys, rows)
+        bare = not CITATION_FILLER_RE.sub("", residue)
+        return found_rows, found_scores, bare
+
+
+class FilterIndex:
+    """Precomputed row indexes for metadata filters.
+
+    Relies on load_chunks() ordering rows by (source, file_path), so each
+    source and each file within a source is a contiguous [start, stop) range;
+    a file_path shared by several sources (e.g. "" on upserted records) maps
+    to one range per source. Section IDs are kept in sorted arrays, as stored
+    and as citation_key()s, so a prefix maps to binary-searched runs and
+    "14." finds "DCS Policy 14.11" as well as "14.6".
+    """
+
+    FIELDS = ("source", "section_prefix", "file_path")
+    COMPARISONS = {"$gt": operator.gt, "$gte": operator.ge, "$lt": operator.lt, "$lte": operator.le}
+
+    def __init__(self, metadata: list):
+        self.size = len(metadata)
+        self._metadata = metadata
+        self._columns = {}  # field -> object array, built on first use by match()
+        self.source_ranges = {source: [span] for source, span in self._ranges(
+            chunk.get("source", "") for chunk in metadata).items()}
+        self.file_ranges = {}  # file_path -> [(start, stop)], one per source
+        files = ((chunk.get("source", ""), chunk.get("file_path", "")) for chunk in metadata)
+        for (_, file_path), span in self._ranges(files).items():
+            self.file_ranges.setdefault(file_path, []).append(span)
+        section_ids = [str(chunk.get("section_id", "")) for chunk in metadata]
+        self.sections = self._sorted([s.upper() for s in section_ids])
+        self.section_keys = self._sorted([citation_key(s) or "" for s in section_ids])
+
+    @staticmethod
+    def _sorted(values: list) -> tuple:
+        """(row order, values in that order) for prefix lookups by binary search."""
+        values = np.array(values, dtype=str)
+        order = np.argsort(values, kind="stable")
+        return order, values[order]
+
+    @staticmethod
+    def _ranges(values) -> dict:
+        """Map each value to its contiguous (start, stop) row range."""
+        ranges = {}
+        for row, value in enumerate(values):
+            if value not in ranges:
+                ranges[value] = (row, row + 1)
+                continue
+            start, stop = ranges[value]
+            if stop != row:
+                raise ValueError(f"Rows for {value!r} are not contiguous; was the corpus sorted?")
+            ranges[value] = (start, row + 1)
+        return ranges
+
+    @staticmethod
+    def _as_list(value, field: str) -> list:
+        values = [value] if isinstance(value, str) else value
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            raise ValueError(f"Filter '{field}' must be a string or list of strings")
+        return values
+
+    def _from_ranges(self, ranges: dict, values: list) -> np.ndarray:
+        parts = [np.arange(*span) for v in values for span in ranges.get(v, ())]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def _section_prefix_rows(self, prefix: str) -> np.ndarray:
+        """Rows whose section ID, as stored or normalized, starts with `prefix`."""
+        runs = [(self.sections, prefix.upper())]
+        runs += [(self.section_keys, key) for key in citation_key_prefixes(prefix)]
+        parts = []
+        for (order, values), start in runs:
+            lo = np.searchsorted(values, start, side="left")
+            hi = np.searchsorted(values, start + "\uffff", side="right")
+            parts.append(order[lo:hi])
+        return np.unique(np.concatenate(parts))
+
+    def resolve(self, filters: dict):
+        """Return sorted matching row indices, or None when no filter applies."""
+        if not filters:
+            return None
+        if not isinstance(filters, dict):
+            raise ValueError("'filter' must be an object")
+        unknown = set(filters) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown filter field(s): {', '.join(sorted(unknown))}")
+
+        rows = None
+        if filters.get("source") is not None:
+            rows = np.sort(self._from_ranges(self.source_ranges, self._as_list(filters["source"], "source")))
+        if filters.get("file_path") is not None:
+            file_rows = np.sort(self._from_ranges(self.file_ranges, self._as_list(filters["file_path"], "file_path")))
+            rows = file_rows if rows is None else np.intersect1d(rows, file_rows, assume_unique=True)
+        if filters.get("section_prefix") is not None:
+            prefix = filters["section_prefix"]
+            if not isinstance(prefix, str):
+                raise ValueError("Filter 'section_prefix' must be a string")
+            section_rows = self._section_prefix_rows(prefix)
+            rows = section_rows if rows is None else np.intersect1d(rows, section_rows, assume_unique=True)
+        return rows
+
+    def match(self, filters: dict) -> np.ndarray:
+        """Sorted rows matching a Pinecone metadata filter.
+
+        Supports {"field": value}, the $eq $ne $gt $gte $lt $lte $in $nin
+        $exists operators and $and/$or. Equality on source and file_path
+        uses the precomputed row ranges; other fields scan a cached column.
+        """
+        if not isinstance(filters, dict):
+            raise ValueError("'filter' must be an object")
+        return np.flatnonzero(self._match(filters))
+
+    def _match(self, filters: dict) -> np.ndarray:
+        mask = np.ones(self.size, dtype=bool)
+        for field, condition in filters.items():
+            if field in ("$and", "$or"):
+                if not (isinstance(condition, list)
+                        and all(isinstance(c, dict) for c in condition)):
+                    raise ValueError(f"'{field}' takes a list of filters")
+                parts = [self._match(c) for c in condition]
+                if field == "$and":
+                    for part in parts:
+                        mask &= part
+                elif parts:
+                    mask &= np.logical_or.reduce(parts)
+                continue
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            for op, value in condition.items():
+                mask &= self._compare(field, op, value)
+        return mask
+
+    def _column(self, field: str) -> np.ndarray:
+        column = self._columns.get(field)
+        if column is None:
+            column = np.fromiter((chunk.get(field) for chunk in self._metadata),
+                                 dtype=object, count=self.size)
+            self._columns[field] = column
+        return column
+
+    def _compare(self, field: str, op: str, value) -> np.ndarray:
+        if op in ("$eq", "$in") and field in ("source", "file_path"):
+            values = [value] if op == "$eq" else value
+            if isinstance(values, list) and all(isinstance(v, str) for v in values):
+                ranges = self.source_ranges if field == "source" else self.file_ranges
+                mask = np.zeros(self.size, dtype=bool)
+                for v in values:
+                    for span in ranges.get(v, ()):
+                        mask[slice(*span)] = True
+                return mask
+        column = self._column(field)
+        if op in ("$eq", "$ne"):
+            mask = np.fromiter((v == value for v in column), dtype=bool, count=self.size)
+            return mask if op == "$eq" else ~mask
+        if op in ("$in", "$nin"):
+            if not isinstance(value, list):
+                raise ValueError(f"'{op}' takes a list")
+            allowed = set(value)
+            # A list-valued field matches when any of its elements does
+            mask = np.fromiter((any(x in allowed for x in v) if isinstance(v, list)
+                                else v in allowed for v in column),
+                               dtype=bool, count=self.size)
+            return mask if op == "$in" else ~mask
+        if op in self.COMPARISONS:
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError(f"'{op}' takes a number")
+            compare = self.COMPARISONS[op]
+            return np.fromiter((isinstance(v, (int, float)) and not isinstance(v, bool)
+                                and compare(v, value) for v in column),
+                               dtype=bool, count=self.size)
+        if op == "$exists":
+            present = np.fromiter((v is not None for v in column), dtype=bool, count=self.size)
+            return present if value else ~present
+        raise ValueError(f"Unsupported filter operator: {op}")
+
+
+def subset(matrix: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Rows of the matrix to score: a zero-copy view when they are contiguous.
+
+    `rows` need not be sorted (IVF candidates come in probe order), so a
+    permutation of a range is not mistaken for the range itself.
+    """
+    if (len(rows) and rows[-1] - rows[0] + 1 == len(rows)
+            and np.all(np.diff(rows) == 1)):
+        return matrix[rows[0]:rows[-1] + 1]
+    return matrix[rows]
+
+
+def section_key(chunk: dict) -> tuple:
+    """The section a chunk belongs to; results carry at most one chunk per section.
+
+    Chunks outside any numbered section (section_id "GENERAL") are keyed by
+    file as well, so unrelated documents don't collapse into one result.
+    """
+    source, section_id = chunk.get("source", ""), chunk.get("section_id", "")
+    if section_id == GENERAL_SECTION:
+        return source, section_id, chunk.get("file_path", "")
+    return source, section_id
+
+
+class SectionGroups:
+    """Integer section id per row, for picking the best k sections in one pass."""
+
+    def __init__(self, metadata: list):
+        ids = {}
+        self.ids = np.fromiter((ids.setdefault(section_key(c), len(ids)) for c in metadata),
+                               dtype=np.int32, count=len(metadata))
+        self.count = len(ids)
+
+    def best(self, scores: np.ndarray, k: int, rows: np.ndarray = None):
+        """(rows, scores) of the best chunk in each of the k best sections, best first.
+
+        scores[i] belongs to rows[i], or to row i when `rows` is None. One
+        scatter-max gives every section's best score; the rows that reach
+        their section's max are then matched against the k winners.
+        """
+        group_ids = self.ids if rows is None else self.ids[rows]
+        group_max = np.full(self.count, -np.inf, dtype=scores.dtype)
+        np.maximum.at(group_max, group_ids, scores)
+
+        top = top_n(group_max, k)
+        top = top[group_max[top] > -np.inf]  # fewer than k sections among the rows
+        leaders = np.flatnonzero(scores >= group_max[group_ids])  # ~one row per section
+        rank = np.full(self.count, len(top))
+        rank[top] = np.arange(len(top))
+        leader_rank = rank[group_ids[leaders]]
+        won = leader_rank < len(top)
+        best_rows = np.empty(len(top), dtype=np.int64)
+        best_rows[leader_rank[won]] = leaders[won]  # on ties, any best row will do
+        if rows is not None:
+            best_rows = rows[best_rows]
+        return best_rows, group_max[top]
+
+
+class NeighborIndex:
+    """Previous and next chunk of the same file for every row, precomputed at load.
+
+    Rows are sorted by (source, file_path, chunk_index), so a chunk's
+    neighbours are the adjacent rows when they belong to the same file and
+    continue its chunk numbering; -1 marks a missing neighbour. Results are
+    mapped back to rows by chunk id, so expanding a hit is O(1).
+    """
+
+    def __init__(self, metadata: list):
+        self.rows = {chunk.get("id"): i for i, chunk in enumerate(metadata)}
+        files = {}
+        file_ids = np.fromiter(
+            (files.setdefault((c.get("source", ""), c.get("file_path", "")), len(files))
+             for c in metadata), dtype=np.int64, count=len(metadata))
+        positions = np.fromiter((c.get("chunk_index", 0) for c in metadata),
+                                dtype=np.int64, count=len(metadata))
+        adjacent = np.flatnonzero((file_ids[1:] == file_ids[:-1])
+                                  & (positions[1:] == positions[:-1] + 1))
+        self.prev = np.full(len(metadata), -1, dtype=np.int32)
+        self.next = np.full(len(metadata), -1, dtype=np.int32)
+        self.prev[adjacent + 1] = adjacent
+        self.next[adjacent] = adjacent + 1
+
+    def around(self, row: int, window: int):
+        """Rows of up to `window` chunks before and after `row`, in file order."""
+        before, after = [], []
+        r = row
+        while len(before) < window and self.prev[r] >= 0:
+            r = self.prev[r]
+            before.append(int(r))
+        r = row
+        while len(after) < window and self.next[r] >= 0:
+            r = self.next[r]
+            after.append(int(r))
+        return before[::-1], after
+
+
+def stitch(texts: list[str]) -> str:
+    """Join consecutive chunk texts into one passage, dropping the text they overlap by.
+
+    ingest_local repeats up to CHUNK_OVERLAP characters of a chunk at the
+    start of the next one; chunks without such an overlap are joined by a
+    blank line.
+    """
+    passage = texts[0]
+    for text in texts[1:]:
+        longest = min(len(passage), len(text), CHUNK_OVERLAP)
+        for size in range(longest, STITCH_MIN_OVERLAP - 1, -1):
+            if passage.endswith(text[:size]):
+                passage += text[size:]
+                break
+        else:
+            passage += "\n\n" + text
+    return passage
+
+
+def expand_context(results: list, metadata: list, neighbors: NeighborIndex, mode: str,
+                   window: int = 1) -> list:
+    """Copies of `results` with up to `window` neighbouring chunks on each side.
+
+    mode="neighbors" adds "context": {"before": [...], "after": [...]} with
+    the id, chunk_index and text of each neighbour; mode="stitch" adds
+    "passage", the neighbours and the hit joined into one text.
+    """
+    expanded = []
+    for result in results:
+        item = dict(result)
+        row = neighbors.rows.get(result["id"])
+        before, after = neighbors.around(row, window) if row is not None else ([], [])
+        if mode == "stitch":
+            item["passage"] = stitch([metadata[r].get("text", "") for r in before]
+                                     + [result["text"]]
+                                     + [metadata[r].get("text", "") for r in after])
+        else:
+            item["context"] = {
+                side: [{"id": metadata[r].get("id", ""),
+                        "chunk_index": metadata[r].get("chunk_index", 0),
+                        "text": metadata[r].get("text", "")} for r in rows]
+                for side, rows in (("before", before), ("after", after))
+            }
+        expanded.append(item)
+    return expanded
+
+
+def collect_results(top_indices, top_scores, metadata: list, top_k: int):
+    """Turn ranked (row, score) candidates into results, deduplicated by section."""
+    results = []
+    seen_sections = set()
+    with STAGE_SECONDS.time(stage="dedup"):
+        for idx, score in zip(top_indices, top_scores):
+            if len(results) >= top_k:
+                break
+            chunk = metadata[idx]
+            # Deduplicate: keep only the best chunk per section
+            key = section_key(chunk)
+            if key in seen_sections:
+                continue
+            seen_sections.add(key)
+            results.append({
+                "id": chunk.get("id", ""),
+                "text": chunk.get("text", ""),
+                "source": chunk.get("source", ""),
+                "title": chunk.get("title", ""),
+                "section_id": chunk.get("section_id", ""),
+                "file_path": chunk.get("file_path", ""),
+                "chunk_index": chunk.get("chunk_index", 0),
+                "score": float(score),
+            })
+    return results
+
+
+def snippet(text: str, limit: int) -> str:
+    """`text` cut to at most `limit` characters, at a word boundary when there is one."""
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    space = cut.rfind(" ")
+    return (cut[:space] if space > 0 else cut).rstrip() + "\u2026"
+
+
+def project(results: list, fields: tuple = DEFAULT_FIELDS, snippet_chars: int = None) -> list:
+    """Keep only the requested fields of each result, shortening text to a snippet.
+
+    Context added by expand_context() is always kept.
+    """
+    projected = []
+    for result in results:
+        item = {field: result[field] for field in fields}
+        for key in ("context", "passage"):
+            if key in result:
+                item[key] = result[key]
+        if snippet_chars is not None and "text" in item:
+            item["text"] = snippet(item["text"], snippet_chars)
+        projected.append(item)
+    return projected
+
+
+def dumps(data) -> bytes:
+    """Serialize a response body (orjson when installed, compact stdlib JSON otherwise)."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def compress(body: bytes, accept_encoding: str):
+    """Return (body, content-encoding) for the client's Accept-Encoding header.
+
+    gzip is preferred over deflate; bodies under COMPRESS_MIN_BYTES and
+    clients that accept neither get the body unchanged with encoding None.
+    """
+    if len(body) < COMPRESS_MIN_BYTES or not accept_encoding:
+        return body, None
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if not (q.startswith("q=") and q[2:].strip() in ("0", "0.0", "0.00", "0.000")):
+            accepted.add(name.strip())
+    for encoding, wbits in (("gzip", 31), ("deflate", 15)):
+        if encoding in accepted or "*" in accepted:
+            compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+            return compressor.compress(body) + compressor.flush(), encoding
+    return body, None
+
+
+def parse_shard(value: str) -> tuple:
+    """argparse type for --shard: "I/N" -> (I, N)."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected I/N, got {value!r}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be in 0..{count - 1}")
+    return index, count
+
+
+def shard_of(chunk: dict, count: int) -> int:
+    """Shard (0..count-1) that holds the chunk's section.
+
+    Partitioning by section keeps every section on one shard, so each
+    shard's deduplicated top-k never overlaps another's. load_chunks()
+    applies it while parsing the corpus.
+    """
+    return zlib.crc32("\0".join(section_key(chunk)).encode()) % count
+
+
+def encode_vector(vec: np.ndarray) -> str:
+    """Base64 of the vector as little-endian float32, the wire format of /search_vector."""
+    return base64.b64encode(np.asarray(vec, dtype="<f4").tobytes()).decode("ascii")
+
+
+def decode_vectors(values, dim: int) -> np.ndarray:
+    """Parse query vectors (base64 float32 or lists of numbers) into a unit-row matrix.
+
+    Raises ValueError for malformed input, reported to the client as a 400.
+    """
+    if not isinstance(values, list) or not values or len(values) > MAX_BATCH_QUERIES:
+        raise ValueError(f"'vectors' must be a list of 1 to {MAX_BATCH_QUERIES} vectors")
+    decoded = []
+    for value in values:
+        if isinstance(value, str):
+            vec = np.frombuffer(base64.b64decode(value, validate=True), dtype="<f4")
+        else:
+            vec = np.asarray(value, dtype=np.float32)
+        if vec.shape != (dim,):
+            raise ValueError(f"Query vectors must have {dim} dimensions")
+        decoded.append(vec)
+    vecs = np.array(decoded, dtype=np.float32)
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vecs / norms
+
+
+def merge_results(partials: list, top_k: int) -> list:
+    """Merge per-shard result lists, each best first, into the overall top-k.
+
+    A k-way heap merge by score, deduplicated by section as collect_results()
+    does, so results stay correct even if a section spans shards.
+    """
+    merged = []
+    seen_sections = set()
+    for result in heapq.merge(*partials, key=lambda r: -r["score"]):
+        key = section_key(result)
+        if key in seen_sections:
+            continue
+        seen_sections.add(key)
+        merged.append(result)
+        if len(merged) >= top_k:
+            break
+    return merged
+
+
+def select(scores: np.ndarray, n: int, rows: np.ndarray = None, groups: SectionGroups = None):
+    """Top-n (rows, scores) from scores of `rows` (or of every row), per section with `groups`."""
+    if groups is not None:
+        return groups.best(scores, n, rows)
+    top = top_n(scores, n)
+    return (rows[top] if rows is not None else top), scores[top]
+
+
+def dense_candidates(query_vec: np.ndarray, matrix: np.ndarray, n: int,
+                     ann: IVFIndex = None, nprobe: int = None, rows: np.ndarray = None,
+                     groups: SectionGroups = None, quantized: QuantizedMatrix = None):
+    """Top-n (rows, cosine scores), best first.
+
+    `rows` restricts scoring to a filtered subset (never approximated by
+    IVF). Otherwise an IVF index, if given, scores only the probed inverted
+    lists; without one every row is scored. With `groups`, the result is the
+    best row of each of the top-n sections instead of the top-n rows. With
+    `quantized`, scoring uses the compact matrix and the best
+    n * QUANT_RESCORE candidates are re-scored in float32.
+    """
+    if rows is None and ann is not None:
+        if groups is None and quantized is None:
+            with STAGE_SECONDS.time(stage="ann"):
+                return ann.search(query_vec, matrix, n, nprobe=nprobe)
+        with STAGE_SECONDS.time(stage="ann"):
+            rows = ann.candidates(query_vec, nprobe)
+            scores = (quantized.scores(query_vec, rows) if quantized is not None
+                      else matrix[rows] @ query_vec)
+    else:
+        with STAGE_SECONDS.time(stage="score"):
+            if quantized is not None:
+                scores = quantized.scores(query_vec, rows)
+            else:
+                # Dot product on pre-normalized vectors
+                scores = (subset(matrix, rows) if rows is not None else matrix) @ query_vec
+
+    if quantized is None:
+        with STAGE_SECONDS.time(stage="select"):
+            return select(scores, n, rows, groups)
+    with STAGE_SECONDS.time(stage="select"):
+        candidates, _ = select(scores, n * QUANT_RESCORE, rows, groups)
+    return rescore(query_vec, matrix, candidates, n)
+
+
+def dense_candidates_many(query_matrix: np.ndarray, matrix: np.ndarray, n: int,
+                          ann: IVFIndex = None, nprobe: int = None, rows: np.ndarray = None,
+                          groups: SectionGroups = None, quantized: QuantizedMatrix = None):
+    """dense_candidates() for several queries; exact scoring is one matrix-matrix product."""
+    if ann is not None and rows is None:
+        return [dense_candidates(q, matrix, n, ann=ann, nprobe=nprobe, groups=groups,
+                                 quantized=quantized)
+                for q in query_matrix]
+
+    n = min(n, len(rows) if rows is not None else len(matrix))
+    if n == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return [(empty, empty.astype(np.float32)) for _ in query_matrix]
+    with STAGE_SECONDS.time(stage="score"):
+        if quantized is not None:
+            scores = quantized.scores(query_matrix, rows)
+        else:
+            scored = subset(matrix, rows) if rows is not None else matrix
+            scores = query_matrix @ scored.T  # (queries, chunks)
+
+    if quantized is not None:
+        with STAGE_SECONDS.time(stage="select"):
+            candidates = [select(s, n * QUANT_RESCORE, rows, groups)[0] for s in scores]
+        return [rescore(q, matrix, c, n) for q, c in zip(query_matrix, candidates)]
+    with STAGE_SECONDS.time(stage="select"):
+        if groups is not None:
+            return [groups.best(s, n, rows) for s in scores]
+        top = np.argpartition(scores, -n, axis=1)[:, -n:]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+    if rows is not None:
+        top = rows[top]
+    return list(zip(top, top_scores))
+
+
+def lexical_candidates(query: str, bm25: BM25Index, n: int, rows: np.ndarray = None,
+                       groups: SectionGroups = None):
+    """Top-n (rows, BM25 scores) among documents matching at least one query term.
+
+    With `groups`, the best row of each of the top-n sections.
+    """
+    with STAGE_SECONDS.time(stage="lexical"):
+        scores = bm25.scores(query)
+        if rows is None:
+            rows = np.flatnonzero(scores)
+        else:
+            rows = rows[scores[rows] > 0]
+        scores = scores[rows]
+        if groups is not None:
+            return groups.best(scores, n, rows)
+        top = top_n(scores, n)
+        return rows[top], scores[top]
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = RRF_K):
+    """Fuse ranked row lists: each row scores sum(1 / (k + rank)) over the lists it appears in."""
+    rankings = [r for r in rankings if len(r)]
+    if not rankings:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    with STAGE_SECONDS.time(stage="fusion"):
+        all_rows = np.concatenate(rankings)
+        weights = np.concatenate([1.0 / (k + np.arange(1, len(r) + 1)) for r in rankings])
+        rows, inverse = np.unique(all_rows, return_inverse=True)
+        fused = np.bincount(inverse, weights=weights)
+        order = np.argsort(-fused, kind="stable")
+        return rows[order], fused[order]
+
+
+def mmr_rerank(ranked, matrix: np.ndarray, k: int, diversity: float, mode: str = "dense",
+               query_vec: np.ndarray = None, groups: SectionGroups = None):
+    """Re-rank (rows, scores) by Maximal Marginal Relevance and keep k.
+
+    Each pick maximizes (1 - diversity) * relevance - diversity * (max cosine
+    to the rows already picked). Relevance is the dense cosine score; hybrid
+    RRF scores are replaced by cosine to `query_vec` and lexical BM25 scores
+    are scaled to [0, 1]. Candidate-to-candidate similarities come from one
+    matmul over the unit vectors, cheap for the MMR_POOL candidates.
+    """
+    rows, scores = ranked
+    if groups is not None and len(rows):
+        # A fused ranking may hold two rows of one section; keep the first
+        _, first = np.unique(groups.ids[rows], return_index=True)
+        first.sort()
+        rows, scores = rows[first], scores[first]
+    k = min(k, len(rows))
+    if k == 0:
+        return rows[:0], scores[:0]
+
+    with STAGE_SECONDS.time(stage="mmr"):
+        if mode == "hybrid":
+            relevance = matrix[rows] @ query_vec
+        elif mode == "lexical":
+            relevance = scores / max(float(np.max(scores)), 1e-9)
+        else:
+            relevance = scores
+        vecs = matrix[rows]
+        similarity = vecs @ vecs.T
+        redundancy = np.zeros(len(rows), dtype=np.float32)
+        available = np.ones(len(rows), dtype=bool)
+        picks = np.empty(k, dtype=np.int64)
+        for i in range(k):
+            gain = (1.0 - diversity) * relevance - diversity * redundancy
+            gain[~available] = -np.inf
+            j = int(np.argmax(gain))
+            picks[i] = j
+            available[j] = False
+            np.maximum(redundancy, similarity[j], out=redundancy)
+    return rows[picks], scores[picks]
+
+
+def search(query_vec: np.ndarray, matrix: np.ndarray, metadata: list, top_k: int = TOP_K,
+           ann: IVFIndex = None, nprobe: int = None, rows: np.ndarray = None,
+           mode: str = "dense", query: str = None, bm25: BM25Index = None, pinned=None,
+           groups: SectionGroups = None, diversity: float = 0.0,
+           quantized: QuantizedMatrix = None):
+    """Return the top-k sections, best chunk of each.
+
+    mode="dense" ranks by cosine similarity; "lexical" ranks by BM25 over
+    `query` (query_vec may be None); "hybrid" fuses both rankings with RRF.
+    `pinned` (rows, scores), e.g. citation hits, are placed ahead of the
+    ranking. Each ranker returns one row per section, so k results come back
+    whenever k sections match. Pass the snapshot's `groups`; building them
+    here on every call is slow. `diversity` > 0 re-ranks the best MMR_POOL
+    sections with mmr_rerank(). `quantized` switches dense scoring to the
+    reduced-precision path (see dense_candidates()).
+    """
+    if groups is None:
+        groups = SectionGroups(metadata)
+    n = max(top_k, MMR_POOL) if diversity > 0 else top_k
+    if mode == "lexical":
+        ranked = lexical_candidates(query, bm25, n, rows, groups)
+    else:
+        depth = max(n, HYBRID_DEPTH) if mode == "hybrid" else n
+        ranked = dense_candidates(query_vec, matrix, depth, ann=ann, nprobe=nprobe, rows=rows,
+                                  groups=groups, quantized=quantized)
+        if mode == "hybrid":
+            lexical, _ = lexical_candidates(query, bm25, depth, rows, groups)
+            ranked = reciprocal_rank_fusion([ranked[0], lexical])
+    if diversity > 0:
+        ranked = mmr_rerank((ranked[0][:n], ranked[1][:n]), matrix, top_k, diversity,
+                            mode, query_vec, groups)
+
+    if pinned is not None and len(pinned[0]):
+        ranked = (np.concatenate([pinned[0], ranked[0]]), np.concatenate([pinned[1], ranked[1]]))
+    return collect_results(*ranked, metadata, top_k)
+
+
+def search_many(query_matrix: np.ndarray, matrix: np.ndarray, metadata: list, top_k: int = TOP_K,
+                ann: IVFIndex = None, nprobe: int = None, rows: np.ndarray = None,
+                mode: str = "dense", queries: list = None, bm25: BM25Index = None,
+                groups: SectionGroups = None, diversity: float = 0.0,
+                quantized: QuantizedMatrix = None):
+    """Search several queries at once; returns one result list per query.
+
+    Dense scoring uses a single matrix-matrix product, so BLAS overhead is
+    paid once for the whole batch; section selection then runs per query.
+    """
+    if groups is None:
+        groups = SectionGroups(metadata)
+    n = max(top_k, MMR_POOL) if diversity > 0 else top_k
+    if mode == "lexical":
+        rankings = [lexical_candidates(q, bm25, n, rows, groups) for q in queries]
+    else:
+        depth = max(n, HYBRID_DEPTH) if mode == "hybrid" else n
+        rankings = dense_candidates_many(query_matrix, matrix, depth, ann=ann, nprobe=nprobe,
+                                         rows=rows, groups=groups, quantized=quantized)
+        if mode == "hybrid":
+            rankings = [
+                reciprocal_rank_fusion([d_rows, lexical_candidates(q, bm25, depth, rows, groups)[0]])
+                for (d_rows, _), q in zip(rankings, queries)
+            ]
+    if diversity > 0:
+        vectors = query_matrix if query_matrix is not None else [None] * len(rankings)
+        rankings = [mmr_rerank((r_rows[:n], r_scores[:n]), matrix, top_k, diversity,
+                               mode, q, groups)
+                    for (r_rows, r_scores), q in zip(rankings, vectors)]
+    return [collect_results(*ranked, metadata, top_k) for ranked in rankings]
+
+
+class QueryCache:
+    """Result cache keyed by query embedding rather than query text.
+
+    Recent query vectors live in one (capacity, dim) matrix, so a lookup is a
+    single matrix-vector product. A new query whose cosine similarity with a
+    cached vector is at least `threshold` (and whose scoring parameters are
+    identical) gets that entry's results. The least recently used slot is
+    overwritten when full. Each CorpusSnapshot owns its cache, so a reload
+    starts empty.
+    """
+
+    def __init__(self, capacity: int = QUERY_CACHE_SIZE,
+                 threshold: float = QUERY_CACHE_THRESHOLD):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.vectors = None  # allocated on first insert, when the dimension is known
+        self.keys = [None] * capacity
+        self.results = [None] * capacity
+        self.last_used = np.zeros(capacity, dtype=np.int64)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def get(self, query_vec: np.ndarray, key):
+        """Cached results for a near-identical query with the same key, else None."""
+        with self._lock:
+            slot = None
+            if self.size:
+                sims = self.vectors[:self.size] @ query_vec
+                close = np.flatnonzero(sims >= self.threshold)
+                for i in close[np.argsort(-sims[close])]:
+                    if self.keys[i] == key:
+                        slot = i
+                        break
+            if slot is None:
+                self.misses += 1
+                QUERY_CACHE.inc(result="miss")
+                return None
+            self._clock += 1
+            self.last_used[slot] = self._clock
+            self.hits += 1
+        QUERY_CACHE.inc(result="hit")
+        return self.results[slot]
+
+    def put(self, query_vec: np.ndarray, key, results: list) -> None:
+        with self._lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.capacity, len(query_vec)), dtype=np.float32)
+            if self.size < self.capacity:
+                slot = self.size
+                self.size += 1
+            else:
+                slot = int(np.argmin(self.last_used))
+            self._clock += 1
+            self.vectors[slot] = query_vec
+            self.keys[slot] = key
+            self.results[slot] = results
+            self.last_used[slot] = self._clock
+
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def describe(self) -> dict:
+        return {
+            "entries": self.size,
+            "capacity": self.capacity,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hit_ratio(), 4),
+        }
+
+
+class SingleFlight:
+    """Run one computation per key at a time and share its result.
+
+    The first caller for a key (the leader) runs the function; callers that
+    arrive with the same key while it is running wait for it and get the
+    same result or exception, so a burst of identical searches costs one
+    embedding call and one scoring pass. Nothing is kept once the leader
+    finishes: repeated queries are the QueryCache's job.
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> [done Event, result, exception]
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, deadline: float = None):
+        """fn() for the leader; the leader's outcome for everyone else.
+
+        A follower whose leader ran out of its own (shorter) deadline tries
+        again rather than inheriting the 504.
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = [threading.Event(), None, None]
+            if leader:
+                try:
+                    call[1] = fn()
+                except BaseException as e:
+                    call[2] = e
+                    raise
+                finally:
+                    with self._lock:
+                        del self._calls[key]
+                    call[0].set()
+                return call[1]
+
+            if not call[0].wait(time_left(deadline)):
+                raise DeadlineExceeded("deadline exceeded waiting for an identical search")
+            if isinstance(call[2], DeadlineExceeded):
+                time_left(deadline)
+                continue
+            COALESCED.inc()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+
+
+class _Pending:
+    """One /search query waiting in a MicroBatcher."""
+    __slots__ = ("query", "snap", "options", "key", "deadline", "done", "results", "error")
+
+    def __init__(self, query, snap, options, key, deadline):
+        self.query = query
+        self.snap = snap
+        self.options = options
+        self.key = key
+        self.deadline = deadline
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class MicroBatcher:
+    """Embed and score concurrent /search queries together.
+
+    Queries that arrive within `window` seconds of the first one in a batch
+    (up to `max_batch`) share one embeddings API call, and those with the
+    same snapshot and scoring parameters share one search_many() matrix-matrix
+    product. The window is only waited out while other searches are in
+    progress, so a query arriving at an idle server is sent right away.
+    Batches run on a thread pool sized like the connection pool, so a slow
+    embeddings call doesn't hold up the batches behind it.
+    """
+
+    def __init__(self, embedder: EmbeddingClient, window: float = BATCH_WINDOW,
+                 max_batch: int = BATCH_MAX, admission: AdmissionControl = None,
+                 workers: int = POOL_SIZE):
+        self.embedder = embedder
+        self.window = window
+        self.max_batch = max_batch
+        self.admission = admission
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch")
+        threading.Thread(target=self._collect, name="micro-batcher", daemon=True).start()
+
+    def search(self, query: str, snap, options: dict, key, deadline: float = None) -> list:
+        """Results for one query, scored with search_many(**options).
+
+        Queries are only scored together when their snapshot and `key` (the
+        query cache key plus mode) match.
+        """
+        pending = _Pending(query, snap, options, key, deadline)
+        self._queue.put(pending)
+        if not pending.done.wait(time_left(deadline)):
+            raise DeadlineExceeded("deadline exceeded waiting for a batched search")
+        if pending.error is not None:
+            raise pending.error
+        return pending.results
+
+    def _others_active(self, batched: int) -> bool:
+        """Whether searches besides the `batched` ones are in progress."""
+        return self.admission is None or self.admission.active > batched
+
+    def _collect(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            flush_at = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                left = flush_at - time.monotonic()
+                if left <= 0 or not self._others_active(len(batch)):
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=left))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._run, batch)
+
+    def _run(self, batch: list) -> None:
+        BATCH_SIZE.observe(len(batch))
+        try:
+            # One call for the batch, allowed as long as its most patient
+            # query; the others stop waiting at their own deadlines.
+            deadlines = [p.deadline for p in batch]
+            deadline = None if None in deadlines else max(deadlines)
+            vectors = self.embedder.embed_many([p.query for p in batch], deadline=deadline)
+            groups = {}
+            for pending, vec in zip(batch, vectors):
+                groups.setdefault((id(pending.snap), pending.key), []).append((pending, vec))
+            for members in groups.values():
+                try:
+                    self._score(members)
+                except Exception as e:
+                    for pending, _ in members:
+                        pending.error = e
+        except Exception as e:
+            for pending in batch:
+                pending.error = e
+        finally:
+            for pending in batch:
+                pending.done.set()
+
+    @staticmethod
+    def _score(members: list) -> None:
+        """Fill in results for queries sharing a snapshot and parameters; cache first."""
+        snap = members[0][0].snap
+        options = members[0][0].options
+        cache = snap.cache if options["mode"] == "dense" else None
+        key = members[0][0].key[1]
+        missing = members
+        if cache is not None:
+            missing = []
+            for pending, vec in members:
+                pending.results = cache.get(vec, key)
+                if pending.results is None:
+                    missing.append((pending, vec))
+        if not missing:
+            return
+        query_matrix = np.array([vec for _, vec in missing])
+        fresh = search_many(query_matrix, snap.matrix, snap.metadata, ann=snap.ann,
+                            queries=[p.query for p, _ in missing], bm25=snap.bm25,
+                            groups=snap.groups, quantized=snap.quantized, **options)
+        for (pending, vec), results in zip(missing, fresh):
+            pending.results = results
+            if cache is not None:
+                cache.put(vec, key, results)
+
+
+class CorpusSnapshot:
+    """One loaded corpus: matrix, metadata and every index derived from them.
+
+    Handlers read SearchHandler.snapshot once per request, so a reload can
+    swap in a new snapshot while in-flight requests finish on the old one.
+    """
+
+    def __init__(self, path: Path, version: str, metadata: list, matrix: np.ndarray,
+                 ann: IVFIndex, bm25: BM25Index, cache: QueryCache = None,
+                 quantized: QuantizedMatrix = None, shard: tuple = None):
+        self.path = path
+        self.version = version
+        self.loaded_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self.metadata = metadata
+        self.matrix = matrix
+        self.ann = ann
+        self.bm25 = bm25
+        self.filters = FilterIndex(metadata)
+        self.citations = CitationIndex(metadata)
+        self.groups = SectionGroups(metadata)
+        self.neighbors = NeighborIndex(metadata)
+        self.cache = cache
+        self.quantized = quantized
+        self.shard = shard
+
+    def describe(self) -> dict:
+        return {
+            "path": str(self.path),
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "chunks": len(self.metadata),
+            "shard": "{}/{}".format(*self.shard) if self.shard is not None else None,
+        }
+
+
+def load_snapshot(path: Path, args) -> CorpusSnapshot:
+    """Load the corpus (or this server's --shard of it) and build or reuse its indexes."""
+    version = corpus_fingerprint(path)
+    metadata, matrix = load_chunks(path, args.shard)
+    if corpus_fingerprint(path) != version:
+        raise RuntimeError(f"{path} changed while it was being loaded")
+
+    tag = ""
+    if args.shard is not None:
+        tag = ".shard{}-of-{}".format(*args.shard)
+        print(f"Shard {args.shard[0]}/{args.shard[1]}: serving {len(metadata)} chunks")
+    return build_snapshot(path, version, metadata, matrix, args, tag)
+
+
+def build_snapshot(path: Path, version: str, metadata: list, matrix: np.ndarray, args,
+                   tag: str = "", reuse_indexes: bool = True) -> CorpusSnapshot:
+    """Build a snapshot's indexes for rows already in load_chunks() order.
+
+    With `reuse_indexes`, IVF and BM25 indexes are loaded from (and saved to)
+    files keyed by the corpus file's fingerprint; rows that no longer match
+    the file, such as live upserts, need them rebuilt instead.
+    """
+    ann = None
+    if args.ann == "ivf" and len(metadata):
+        if reuse_indexes:
+            ann = load_or_build_ivf(matrix, path, nlist=args.nlist, nprobe=args.nprobe, tag=tag)
+        else:
+            ann = IVFIndex.build(matrix, nlist=args.nlist, nprobe=args.nprobe)
+        if args.ann_recall_check:
+            r = ann_recall(ann, matrix)
+            print(f"IVF recall@{r['k']} = {r['recall']:.3f} (nprobe={r['nprobe']}, "
+                  f"{r['ann_ms']:.2f} ms vs {r['exact_ms']:.2f} ms exact)")
+    if reuse_indexes:
+        bm25 = load_or_build_bm25(metadata, path, tag=tag)
+    else:
+        bm25 = BM25Index.build([chunk.get("text", "") for chunk in metadata])
+    cache = QueryCache(args.cache_size, args.cache_threshold) if args.cache_size > 0 else None
+
+    quantized = None
+    if args.precision != "float32" and len(metadata):
+        quantized = QuantizedMatrix.build(matrix, args.precision)
+        if args.precision_recall_check:
+            quantized.recall = r = quantized_recall(quantized, matrix)
+            print(f"{args.precision} recall@{r['k']} = {r['recall']:.3f} "
+                  f"({r['quantized_ms']:.2f} ms vs {r['exact_ms']:.2f} ms exact)")
+        mapped = memory_map_matrix(matrix, path, tag)  # frees the in-memory float32 copy
+        where = "memory-mapped file" if mapped is not matrix else "copy kept in memory"
+        matrix = mapped
+        print(f"Scoring a {quantized.nbytes / 1e6:.1f} MB {args.precision} matrix; "
+              f"float32 re-rank from a {matrix.nbytes / 1e6:.1f} MB {where}")
+    return CorpusSnapshot(path, version, metadata, matrix, ann, bm25, cache, quantized,
+                          args.shard)
+
+
+class CorpusReloader:
+    """Rebuild the snapshot in the background when the corpus changes or on request.
+
+    A changed file is only loaded once its size/mtime has been stable for one
+    polling interval, so a half-written corpus is never picked up. Failed
+    reloads are logged and the current snapshot keeps serving.
+    """
+
+    def __init__(self, path: Path, args, install, interval: float = RELOAD_INTERVAL):
+        self.path = path
+        self.args = args
+        self.install = install
+        self.interval = interval
+        self.current = corpus_fingerprint(path)
+        self._pending = None
+        self._requested = threading.Event()
+        self._last_check = time.monotonic()
+
+    def request_reload(self) -> None:
+        """Reload on the next wake-up regardless of whether the file changed (e.g. SIGHUP)."""
+        self._requested.set()
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self._run, name="corpus-reloader", daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self) -> None:
+        while True:
+            self.tick(self.interval if self.interval > 0 else None)
+
+    def tick(self, timeout: float = None) -> None:
+        """Wait up to `timeout` for a reload request, then check the corpus if due.
+
+        The background thread calls this in a loop; the pre-fork supervisor
+        calls it from its own main loop instead.
+        """
+        forced = self._requested.wait(timeout)
+        self._requested.clear()
+        now = time.monotonic()
+        if not forced and (self.interval <= 0 or now - self._last_check < self.interval):
+            return
+        self._last_check = now
+        try:
+            fingerprint = corpus_fingerprint(self.path)
+        except OSError:
+            return  # file is being replaced; check again next tick
+        if not forced:
+            if fingerprint == self.current:
+                self._pending = None
+                return
+            if fingerprint != self._pending:
+                self._pending = fingerprint  # wait for the writer to finish
+                return
+        self._reload()
+
+    def _reload(self) -> None:
+        start = time.perf_counter()
+        print(f"Reloading corpus from {self.path} ...")
+        try:
+            snapshot = load_snapshot(self.path, self.args)
+        except Exception as e:
+            print(f"Reload failed, still serving version {self.current}: {e}", file=sys.stderr)
+            return
+        self.install(snapshot)
+        self.current = snapshot.version
+        self._pending = None
+        print(f"Now serving corpus version {snapshot.version} "
+              f"({len(snapshot.metadata)} chunks, reloaded in {time.perf_counter() - start:.1f}s)")
+
+
+class LiveUpdates:
+    """Pinecone-style upserts and deletes applied on top of the loaded corpus.
+
+    Writes are queued and a background thread folds them into a new
+    snapshot at most every `interval` seconds, so a burst of upsert batches
+    costs one index rebuild. Like Pinecone, writes become visible to
+    queries shortly after they are acknowledged. The new snapshot is
+    installed the same way as a reload; changes live in memory only and
+    are dropped when the corpus file itself is reloaded.
+    """
+
+    def __init__(self, args, current, install, interval: float = LIVE_APPLY_INTERVAL):
+        self.args = args
+        self.current = current  # returns the snapshot being served
+        self.install = install
+        self.interval = interval
+        self.lock = threading.Lock()  # held while a snapshot is swapped in
+        self.applied = 0
+        self._pending = []
+        self._queued = threading.Condition()
+
+    def upsert(self, vectors: list) -> None:
+        """Queue (id, unit vector, metadata) records; existing ids are replaced."""
+        self._enqueue(("upsert", vectors))
+
+    def delete(self, ids: list) -> None:
+        self._enqueue(("delete", ids))
+
+    def delete_all(self) -> None:
+        self._enqueue(("delete_all", None))
+
+    def _enqueue(self, op) -> None:
+        with self._queued:
+            self._pending.append(op)
+            self._queued.notify()
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self._run, name="live-updates", daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self) -> None:
+        while True:
+            with self._queued:
+                while not self._pending:
+                    self._queued.wait()
+            time.sleep(self.interval)  # let the rest of a batch of writes arrive
+            with self._queued:
+                ops, self._pending = self._pending, []
+            try:
+                self._apply(ops)
+            except Exception as e:
+                print(f"Applying {len(ops)} queued write(s) failed: {e}", file=sys.stderr)
+
+    def _apply(self, ops: list) -> None:
+        start = time.perf_counter()
+        base = self.current()
+        metadata = list(base.metadata)
+        matrix = np.array(base.matrix, dtype=np.float32)
+        rows = base.neighbors.rows  # id -> row
+        alive = np.ones(len(metadata), dtype=bool)
+        added = {}  # id -> (chunk, vector), for ids not in the base snapshot
+        for kind, payload in ops:
+            if kind == "delete_all":
+                alive[:] = False
+                added.clear()
+            elif kind == "delete":
+                for chunk_id in payload:
+                    added.pop(chunk_id, None)
+                    if chunk_id in rows:
+                        alive[rows[chunk_id]] = False
+            else:
+                for chunk_id, vector, fields in payload:
+                    chunk = {**fields, "id": chunk_id}
+                    row = rows.get(chunk_id)
+                    if row is not None and alive[row]:
+                        metadata[row] = chunk
+                        matrix[row] = vector
+                    else:
+                        added[chunk_id] = (chunk, vector)
 
+        keep = np.flatnonzero(alive)
+        metadata = [metadata[i] for i in keep] + [chunk for chunk, _ in added.values()]
+        vectors = [vector for _, vector in added.values()]
+        matrix = np.concatenate([matrix[keep], np.array(vectors, dtype=np.float32)
+                                 .reshape(len(vectors), matrix.shape[1])])
+        order = sorted(range(len(metadata)), key=lambda i: row_sort_key(metadata[i]))
+        metadata = [metadata[i] for i in order]
+        matrix = matrix[order]
 
-def load_env(path: Path) -> None:
-    """Load key=value pairs from a .env.local file into os.environ."""
-    if not path.exists():
-        return
-    with open(path) as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith("#"):
+        with self.lock:
+            if self.current() is not base:
+                print("Corpus reloaded while applying writes; they were dropped", file=sys.stderr)
+                return
+            self.applied += len(ops)
+            version = f"{base.version.split('+')[0]}+live{self.applied}"
+            snapshot = build_snapshot(base.path, version, metadata, matrix, self.args,
+                                      reuse_indexes=False)
+            self.install(snapshot)
+        print(f"Applied {len(ops)} queued write(s): now {len(metadata)} chunks "
+              f"({time.perf_counter() - start:.2f}s)")
+
+
+def share_matrix(matrix: np.ndarray):
+    """Copy the matrix into POSIX shared memory; returns (segment, ndarray view)."""
+    shm = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+    shared = np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=shm.buf)
+    shared[:] = matrix
+    return shm, shared
+
+
+def release_shared(shm: shared_memory.SharedMemory) -> None:
+    """Unlink a segment; workers that still map it keep it alive until they exit."""
+    try:
+        shm.close()
+    except BufferError:
+        pass  # a view is still referenced here; the mapping is freed at exit
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class PreforkSupervisor:
+    """Run N worker processes on one listening socket and one shared-memory matrix.
+
+    The parent never serves requests. It restarts crashed workers and, on
+    reload, shares the new matrix, forks a fresh generation of workers and
+    sends SIGTERM to the old generation. Old workers stop accepting, finish
+    their in-flight requests, then exit. Other read-only snapshot data
+    (metadata, indexes) is shared copy-on-write through fork.
+    """
+
+    def __init__(self, server, count: int, run_worker):
+        self.server = server
+        self.count = count
+        self.run_worker = run_worker
+        self.snapshot = None
+        self.shm = None
+        self.generation = 0
+        self.workers = {}  # pid -> (generation, started_at)
+        self.stopping = False
+
+    def install(self, snapshot: CorpusSnapshot) -> None:
+        """Serve `snapshot` from a new generation of workers (startup and reload)."""
+        if snapshot.quantized is not None:
+            # The float32 matrix is a file mapping, already shared via the page cache
+            # (or, if memory_map_matrix() found no writable directory, copy-on-write)
+            shm, snapshot.quantized.codes = share_matrix(snapshot.quantized.codes)
+        else:
+            shm, snapshot.matrix = share_matrix(snapshot.matrix)
+        old_shm = self.shm
+        self.snapshot, self.shm = snapshot, shm
+        gc.collect()
+        if old_shm is not None:
+            # Drop the parent's mapping before forking so new workers don't inherit it
+            release_shared(old_shm)
+
+        old = [pid for pid, (gen, _) in self.workers.items() if gen == self.generation]
+        self.generation += 1
+        gc.freeze()  # keep GC from dirtying copy-on-write pages in the workers
+        for _ in range(self.count):
+            self._spawn()
+        for pid in old:
+            self._signal(pid, signal.SIGTERM)
+
+    def _spawn(self) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.run_worker(self.server, self.snapshot)
+                code = 0
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        self.workers[pid] = (self.generation, time.monotonic())
+
+    @staticmethod
+    def _signal(pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def reap(self) -> None:
+        """Collect exited workers and replace any from the current generation."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid not in self.workers:
                 continue
-            if "=" in line:
-                key, _, value = line.partition("=")
-                os.environ.setdefault(key.strip(), value.strip())
+            generation, started_at = self.workers.pop(pid)
+            if generation != self.generation or self.stopping:
+                continue
+            print(f"Worker {pid} exited with status {status}; restarting", file=sys.stderr)
+            if time.monotonic() - started_at < 1.0:
+                time.sleep(1.0)  # don't spin if workers crash on startup
+            self._spawn()
 
+    def stop(self, timeout: float = 30.0) -> None:
+        self.stopping = True
+        for pid in list(self.workers):
+            self._signal(pid, signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.05)
+        for pid in list(self.workers):
+            self._signal(pid, signal.SIGKILL)
+        self.snapshot = None
+        gc.collect()
+        if self.shm is not None:
+            release_shared(self.shm)
 
-def load_env_paths(paths: list[Path]) -> None:
-    """Load key=value pairs from multiple env files (first wins)."""
-    for path in paths:
-        load_env(path)
 
+class ShardError(RuntimeError):
+    """A shard failed or answered with an error; the search is answered with 502."""
 
-def load_chunks(path: Path):
-    """Load chunks and separate metadata from embeddings matrix."""
-    print(f"Loading chunks from {path} ...")
-    with open(path) as f:
-        raw = json.load(f)
 
-    metadata = []
-    embeddings = []
-    for chunk in raw:
-        emb = chunk.pop("embedding")
-        metadata.append(chunk)
-        embeddings.append(emb)
+class ShardClient:
+    """POST /search_vector requests to one shard server over pooled keep-alive connections."""
 
-    matrix = np.array(embeddings, dtype=np.float32)
-    # Pre-normalize rows for fast cosine similarity (dot product on unit vectors)
-    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
-    norms[norms == 0] = 1.0
-    matrix = matrix / norms
+    def __init__(self, url: str, pool_size: int = POOL_SIZE,
+                 connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.pool = ConnectionPool(url, size=pool_size, connect_timeout=connect_timeout,
+                                   read_timeout=read_timeout)
 
-    print(f"Loaded {len(metadata)} chunks, embedding matrix shape: {matrix.shape}")
-    return metadata, matrix
+    def search(self, body: bytes, deadline: float = None) -> list:
+        """Send an encoded /search_vector request; returns one result list per vector."""
+        try:
+            status, raw = self.pool.request("POST", "/search_vector", body=body,
+                                            headers={"Content-Type": "application/json"},
+                                            deadline=deadline)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            SHARD_ERRORS.inc(shard=self.url, reason=type(e).__name__)
+            if isinstance(e, TimeoutError) and deadline is not None \
+                    and time.monotonic() >= deadline:
+                raise DeadlineExceeded(f"deadline exceeded waiting for {self.url}") from e
+            raise ShardError(f"Shard {self.url} failed: {e}") from e
+        if status == 200:
+            return json.loads(raw)["results"]
+        if status == 400:
+            raise ValueError(json.loads(raw).get("error", "Rejected by shard"))
+        SHARD_ERRORS.inc(shard=self.url, reason=f"http_{status}")
+        if status == 503:
+            raise Overloaded(f"Shard {self.url} is overloaded", RETRY_AFTER, "shard_busy")
+        if status == 504:
+            raise DeadlineExceeded(f"deadline exceeded on {self.url}")
+        raise ShardError(f"Shard {self.url} returned HTTP {status}: {raw[:200]!r}")
 
 
-def get_query_embedding(text: str, api_key: str) -> np.ndarray:
-    """Call OpenAI embeddings API and return the vector."""
-    import urllib.request
+class ShardCoordinator:
+    """Fan dense searches out to every shard in parallel and merge their top-k lists.
 
-    req_body = json.dumps({
-        "model": EMBEDDING_MODEL,
-        "input": text,
-        "dimensions": EMBEDDING_DIM,
-    }).encode()
+    The query is embedded once by the caller; each shard receives the
+    vectors and returns its own best sections, which merge_results()
+    combines. A failure on any shard fails the search, since its sections
+    would otherwise be silently missing.
+    """
 
-    req = urllib.request.Request(
-        "https://api.openai.com/v1/embeddings",
-        data=req_body,
-        headers={
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        },
-    )
+    def __init__(self, urls: list, pool_size: int = POOL_SIZE,
+                 connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT):
+        self.shards = [ShardClient(url, pool_size, connect_timeout, read_timeout) for url in urls]
+        self._executor = ThreadPoolExecutor(max_workers=len(urls) * pool_size,
+                                            thread_name_prefix="shard")
 
-    with urllib.request.urlopen(req) as resp:
-        data = json.loads(resp.read())
+    def search_many(self, query_matrix: np.ndarray, top_k: int, options: dict,
+                    fields: tuple = DEFAULT_FIELDS, snippet_chars: int = None,
+                    deadline: float = None) -> list:
+        """Top-k results for each query vector across all shards.
 
-    vec = np.array(data["data"][0]["embedding"], dtype=np.float32)
-    vec = vec / np.linalg.norm(vec)
-    return vec
+        `options` holds the per-request scoring parameters passed through to
+        the shards (filter, nprobe); shards return only the requested
+        fields plus those the merge needs.
+        """
+        request = dict(options, vectors=[encode_vector(vec) for vec in query_matrix],
+                       top_k=top_k, fields=list(dict.fromkeys(fields + MERGE_FIELDS)),
+                       snippet_chars=snippet_chars)
+        left = time_left(deadline)
+        if left is not None:
+            request["timeout_ms"] = left * 1000
+        body = dumps(request)
+        with STAGE_SECONDS.time(stage="shards"):
+            futures = [self._executor.submit(shard.search, body, deadline)
+                       for shard in self.shards]
+            partials = [future.result() for future in futures]
+        with STAGE_SECONDS.time(stage="merge"):
+            merged = [merge_results([p[i] for p in partials], top_k)
+                      for i in range(len(query_matrix))]
+        return [project(results, fields) for results in merged]
 
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+        for shard in self.shards:
+            shard.pool.close()
 
-def search(query_vec: np.ndarray, matrix: np.ndarray, metadata: list, top_k: int = TOP_K):
-    """Compute cosine similarities and return top-k results, deduplicated by section."""
-    scores = matrix @ query_vec  # dot product on pre-normalized vectors
-    # Get more candidates than needed so we can deduplicate
-    candidate_k = min(top_k * 4, len(metadata))
-    top_indices = np.argpartition(scores, -candidate_k)[-candidate_k:]
-    top_indices = top_indices[np.argsort(scores[top_indices])[::-1]]
 
-    results = []
-    seen_sections = set()
-    for idx in top_indices:
-        if len(results) >= top_k:
-            break
-        chunk = metadata[idx]
-        # Deduplicate: keep only the best chunk per (source, section_id) pair
-        section_key = (chunk.get("source", ""), chunk.get("section_id", ""))
-        if section_key in seen_sections:
-            continue
-        seen_sections.add(section_key)
-        results.append({
-            "text": chunk.get("text", ""),
-            "source": chunk.get("source", ""),
-            "title": chunk.get("title", ""),
-            "section_id": chunk.get("section_id", ""),
-            "score": float(scores[idx]),
+def render_metrics(snapshot: CorpusSnapshot, admission: AdmissionControl = None,
+                   breaker: CircuitBreaker = None) -> str:
+    """Prometheus text exposition of all server metrics (snapshot is None on a coordinator)."""
+    gauges = [
+        Gauge("process_resident_memory_bytes", "Resident memory of the server process",
+              resident_memory_bytes),
+    ]
+    if snapshot is not None:
+        gauges += [
+            Gauge("search_corpus_chunks", "Chunks in the served corpus",
+                  lambda: len(snapshot.metadata)),
+            Gauge("search_matrix_bytes", "Size of the embedding matrix",
+                  lambda: snapshot.matrix.nbytes),
+            Gauge("search_matrix_dimensions", "Embedding dimensions",
+                  lambda: snapshot.matrix.shape[1]),
+        ]
+    if snapshot is not None and snapshot.quantized is not None:
+        gauges.append(Gauge("search_scoring_matrix_bytes", "Size of the reduced-precision matrix",
+                            lambda: snapshot.quantized.nbytes))
+        if snapshot.quantized.recall is not None:
+            gauges.append(Gauge("search_quantized_recall", "Startup recall@10 of quantized scoring",
+                                lambda: snapshot.quantized.recall["recall"]))
+    if admission is not None:
+        gauges += [
+            Gauge("search_active_requests", "Searches being processed", lambda: admission.active),
+            Gauge("search_queued_requests", "Searches waiting for a slot", lambda: admission.waiting),
+        ]
+    if breaker is not None:
+        gauges.append(Gauge("search_embedding_circuit_open",
+                            "1 while the embeddings circuit breaker refuses calls",
+                            lambda: int(breaker.state == "open")))
+    if snapshot is not None and snapshot.cache is not None:
+        gauges += [
+            Gauge("search_query_cache_entries", "Queries held in the semantic cache",
+                  lambda: snapshot.cache.size),
+            Gauge("search_query_cache_hit_ratio", "Semantic cache hit ratio since the last reload",
+                  snapshot.cache.hit_ratio),
+        ]
+    lines = []
+    for metric in (REQUESTS, REQUEST_SECONDS, STAGE_SECONDS, EMBEDDING_ERRORS, QUERY_CACHE,
+                   HEDGES, COALESCED, BATCH_SIZE, REJECTED, SHARD_ERRORS, *gauges):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """Wall-clock stack sampler over the server's own threads.
+
+    Every `interval` seconds it records the Python stack of each thread
+    that is running one of the `busy` code objects (request handling,
+    batch scoring, embeddings calls), or of every thread with `busy=None`.
+    Idle keep-alive and pool threads would otherwise dominate the profile.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL, busy: frozenset = None):
+        self.interval = interval
+        self.busy = busy
+        self.stacks = {}  # ((file, first line, function), ...) outermost first -> samples
+        self.rounds = 0
+        self.elapsed = 0.0
+
+    def run(self, seconds: float, requests: int = None) -> None:
+        """Sample the other threads for `seconds`, or until `requests` more have completed."""
+        start = time.monotonic()
+        done_before = REQUESTS.total()
+        me = threading.get_ident()
+        while time.monotonic() - start < seconds:
+            if requests is not None and REQUESTS.total() - done_before >= requests:
+                break
+            self._sample(me)
+            time.sleep(self.interval)
+        self.elapsed = time.monotonic() - start
+
+    def _sample(self, me: int) -> None:
+        self.rounds += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            busy = self.busy is None
+            while frame is not None:
+                code = frame.f_code
+                busy = busy or code in self.busy
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            if busy:
+                key = tuple(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def collapsed(self) -> str:
+        """One "outer;...;inner count" line per stack, for flamegraph.pl or speedscope."""
+        lines = []
+        for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+            frames = ";".join(f"{name} ({os.path.basename(file)}:{line})"
+                              for file, line, name in stack)
+            lines.append(f"{frames} {count}")
+        return "".join(line + "\n" for line in lines)
+
+    def pstats(self) -> bytes:
+        """The samples as a marshalled pstats table (pstats.Stats, snakeviz).
+
+        Call counts are sample counts, and times are samples times the
+        measured sampling period, so they are wall-clock estimates.
+        """
+        period = self.elapsed / self.rounds if self.rounds else 0.0
+        stats = {}  # function -> [cc, nc, tt, ct, {caller: [cc, nc, tt, ct]}]
+        for stack, count in self.stacks.items():
+            t = count * period
+            seen = set()
+            for i, func in enumerate(stack):
+                entry = stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+                leaf = i == len(stack) - 1
+                if func not in seen:  # recursive frames count once per sample
+                    seen.add(func)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += t
+                if leaf:
+                    entry[2] += t
+                if i:
+                    caller = entry[4].setdefault(stack[i - 1], [0, 0, 0.0, 0.0])
+                    caller[0] += count
+                    caller[1] += count
+                    caller[2] += t if leaf else 0.0
+                    caller[3] += t
+        return marshal.dumps({
+            func: (cc, nc, tt, ct, {caller: tuple(v) for caller, v in callers.items()})
+            for func, (cc, nc, tt, ct, callers) in stats.items()
         })
-    return results
+
+
+def approx_size(obj, depth: int = 3, seen: set = None) -> int:
+    """Rough bytes held by `obj`: array buffers plus containers, `depth` levels down.
+
+    Objects already in `seen` count zero, so structures sharing the
+    metadata list or its strings aren't charged for them twice.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if obj is None or depth == 0:
+        return sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(approx_size(k, depth - 1, seen)
+                                        + approx_size(v, depth - 1, seen)
+                                        for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(approx_size(v, depth - 1, seen) for v in obj)
+    if hasattr(obj, "__dict__"):
+        return sys.getsizeof(obj) + sum(approx_size(v, depth - 1, seen)
+                                        for v in vars(obj).values())
+    return sys.getsizeof(obj)
+
+
+def memory_report(snapshot: CorpusSnapshot, top: int = 20) -> dict:
+    """Sizes of the snapshot's structures plus, while tracemalloc runs, the top allocation sites."""
+    objects = {}
+    seen = set()
+    if snapshot is not None:
+        parts = {
+            "matrix": snapshot.matrix, "scoring_matrix": snapshot.quantized,
+            "metadata": snapshot.metadata, "ivf": snapshot.ann, "bm25": snapshot.bm25,
+            "filters": snapshot.filters, "citations": snapshot.citations,
+            "section_groups": snapshot.groups, "neighbors": snapshot.neighbors,
+            "query_cache": snapshot.cache,
+        }
+        for name, obj in parts.items():
+            if obj is None:
+                continue
+            entry = {"bytes": approx_size(obj, seen=seen)}
+            traceback = tracemalloc.get_object_traceback(obj)
+            if traceback is not None:
+                entry["allocated_at"] = str(traceback[-1])
+            objects[name] = entry
+    report = {"pid": os.getpid(), "rss_bytes": resident_memory_bytes(), "objects": objects,
+              "tracemalloc": {"tracing": tracemalloc.is_tracing()}}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        stats = tracemalloc.take_snapshot().statistics("lineno")
+        report["tracemalloc"].update({
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "top": [{"where": str(stat.traceback[-1]), "bytes": stat.size, "count": stat.count}
+                    for stat in stats[:top]],
+        })
+    return report
 
 
 class SearchHandler(BaseHTTPRequestHandler):
-    metadata = None
-    matrix = None
-    api_key = None
+    snapshot = None
+    embedder = None
+    admission = None
+    live = None  # LiveUpdates when writes are accepted (--allow-writes, single process only)
+    write_key = None  # Api-Key header writes must carry, when set
+    flights = None  # SingleFlight coalescing identical concurrent searches
+    debug_token = None  # enables /debug/profile and /debug/memory
+    batcher = None  # MicroBatcher embedding and scoring concurrent searches together
+    request_deadline = REQUEST_DEADLINE
+    # Headers and body go out in separate writes; without TCP_NODELAY the body
+    # waits for the client's delayed ACK (~40 ms on Linux) on every response.
+    disable_nagle_algorithm = True
+
+    ENDPOINTS = ("/search", "/search_batch", "/search_vector", "/health", "/metrics",
+                 "/query", "/vectors/upsert", "/vectors/delete", "/vectors/fetch",
+                 "/describe_index_stats")
+    ROUTES = {"/search": "_search", "/search_batch": "_search_batch",
+              "/search_vector": "_search_vector", "/query": "_pinecone_query",
+              "/vectors/upsert": "_pinecone_upsert", "/vectors/delete": "_pinecone_delete",
+              "/describe_index_stats": "_describe_index_stats"}
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+
+    def _observe(self, start: float) -> None:
+        path = urlsplit(self.path).path
+        endpoint = path if path in self.ENDPOINTS else "other"
+        REQUESTS.inc(endpoint=endpoint, status=getattr(self, "_status", 0))
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
 
     def do_POST(self):
-        if self.path != "/search":
+        start = time.perf_counter()
+        try:
+            self._handle_post()
+        finally:
+            self._observe(start)
+
+    def _handle_post(self):
+        arrived = time.monotonic()
+        if self.path not in self.ROUTES:
             self.send_error(404, "Not found")
             return
 
@@ -151,33 +3042,534 @@ class SearchHandler(BaseHTTPRequestHandler):
         except json.JSONDecodeError:
             self._respond(400, {"error": "Invalid JSON"})
             return
+        if not isinstance(payload, dict):
+            self._respond(400, {"error": "Expected a JSON object"})
+            return
+
+        try:
+            timeout = min(float(payload.get("timeout_ms", math.inf)) / 1000,
+                          self.request_deadline)
+            if not timeout > 0:
+                raise ValueError("'timeout_ms' must be positive")
+        except (TypeError, ValueError) as e:
+            self._respond(400, {"error": str(e)})
+            return
+        self.deadline = arrived + timeout
+
+        try:
+            self.admission.acquire(self.deadline)
+        except (Overloaded, DeadlineExceeded) as e:
+            self._shed(e)
+            return
+        try:
+            getattr(self, self.ROUTES[self.path])(payload)
+        finally:
+            self.admission.release()
+
+    def _shed(self, error: Exception) -> None:
+        """Answer a refused (503) or timed-out (504) search."""
+        if isinstance(error, Overloaded):
+            REJECTED.inc(reason=error.reason)
+            self._respond(503, {"error": str(error)},
+                          headers={"Retry-After": str(math.ceil(error.retry_after))})
+        else:
+            REJECTED.inc(reason="deadline")
+            self._respond(504, {"error": str(error)})
+
+    def _params(self, payload: dict, snap: CorpusSnapshot):
+        """Parse the scoring parameters shared by /search and /search_batch.
+
+        Raises ValueError for malformed values, reported to the client as a 400.
+        """
+        top_k = min(int(payload.get("top_k", TOP_K)), MAX_TOP_K)
+        nprobe = payload.get("nprobe")
+        nprobe = int(nprobe) if nprobe is not None else None
+        rows = snap.filters.resolve(payload.get("filter"))
+        mode = payload.get("mode", "dense")
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"'mode' must be one of: {', '.join(SEARCH_MODES)}")
+        diversity = float(payload.get("diversity", 0.0))
+        if not 0.0 <= diversity <= 1.0:
+            raise ValueError("'diversity' must be between 0 and 1")
+        return top_k, nprobe, rows, mode, diversity
 
+    @staticmethod
+    def _shape(payload: dict):
+        """Parse the response-shaping options: (fields, snippet_chars, context, window).
+
+        Raises ValueError for malformed values, reported to the client as a 400.
+        """
+        fields = payload.get("fields", DEFAULT_FIELDS)
+        if isinstance(fields, str):
+            fields = [fields]
+        unknown = [f for f in fields if f not in RESULT_FIELDS]
+        if unknown or not fields:
+            raise ValueError(f"'fields' must be a non-empty list of: {', '.join(RESULT_FIELDS)}")
+        snippet_chars = payload.get("snippet_chars")
+        if snippet_chars is not None:
+            snippet_chars = int(snippet_chars)
+            if snippet_chars < 1:
+                raise ValueError("'snippet_chars' must be positive")
+        context = payload.get("context")
+        if context is not None and context not in CONTEXT_MODES:
+            raise ValueError(f"'context' must be one of: {', '.join(CONTEXT_MODES)}")
+        window = int(payload.get("context_chunks", 1))
+        if not 1 <= window <= MAX_CONTEXT_CHUNKS:
+            raise ValueError(f"'context_chunks' must be between 1 and {MAX_CONTEXT_CHUNKS}")
+        return tuple(fields), snippet_chars, context, window
+
+    @staticmethod
+    def _present(results: list, snap: CorpusSnapshot, shape: tuple) -> list:
+        """One result list as sent to the client: context expanded, then fields projected."""
+        fields, snippet_chars, context, window = shape
+        if context is not None:
+            results = expand_context(results, snap.metadata, snap.neighbors, context, window)
+        return project(results, fields, snippet_chars)
+
+    @staticmethod
+    def _cache_key(payload: dict, top_k: int, nprobe, diversity: float):
+        """Everything besides the query vector that shapes a dense result list."""
+        return top_k, nprobe, diversity, json.dumps(payload.get("filter"), sort_keys=True)
+
+    def _search(self, payload: dict):
+        snap = self.snapshot
         query = payload.get("query")
         if not query or not isinstance(query, str):
             self._respond(400, {"error": "Missing or invalid 'query' field"})
             return
 
         try:
-            top_k = min(int(payload.get("top_k", TOP_K)), 20)
-            query_vec = get_query_embedding(query, self.api_key)
-            results = search(query_vec, self.matrix, self.metadata, top_k=top_k)
-            self._respond(200, {"results": results})
+            top_k, nprobe, rows, mode, diversity = self._params(payload, snap)
+            shape = self._shape(payload)
+            citation_mode = payload.get("citations", "auto")
+            if citation_mode not in CITATION_MODES:
+                raise ValueError(f"'citations' must be one of: {', '.join(CITATION_MODES)}")
+        except (TypeError, ValueError) as e:
+            self._respond(400, {"error": str(e)})
+            return
+
+        try:
+            if rows is not None and len(rows) == 0:
+                self._respond(200, {"results": []})
+                return
+
+            def run():
+                return self._rank(query, payload, snap, top_k, nprobe, rows, mode, diversity,
+                                  citation_mode)
+            if self.flights is not None:
+                # Whitespace doesn't change the answer; the snapshot version
+                # keeps a reload from handing out the old corpus's results.
+                key = (snap.version, " ".join(query.split()), mode, citation_mode,
+                       self._cache_key(payload, top_k, nprobe, diversity))
+                results = self.flights.do(key, run, self.deadline)
+            else:
+                results = run()
+            self._respond(200, {"results": self._present(results, snap, shape)})
+        except (Overloaded, DeadlineExceeded) as e:
+            self._shed(e)
+        except Exception as e:
+            print(f"Search error: {e}", file=sys.stderr)
+            self._respond(500, {"error": str(e)})
+
+    def _rank(self, query: str, payload: dict, snap: CorpusSnapshot, top_k: int, nprobe,
+              rows, mode: str, diversity: float, citation_mode: str) -> list:
+        """Full result list for one /search query, before response shaping."""
+        pinned = None
+        if citation_mode != "off":
+            with STAGE_SECONDS.time(stage="citation"):
+                cited_rows, cited_scores, bare = snap.citations.match(query, rows)
+            if bare and citation_mode == "auto" and len(cited_rows):
+                # Plain citation: answer from the index, no embedding or scan
+                return collect_results(cited_rows, cited_scores, snap.metadata, top_k)
+            if citation_mode == "blend":
+                pinned = (cited_rows, cited_scores)
+
+        if self.batcher is not None and mode != "lexical" and pinned is None:
+            options = {"top_k": top_k, "nprobe": nprobe, "rows": rows, "mode": mode,
+                       "diversity": diversity}
+            key = (mode, self._cache_key(payload, top_k, nprobe, diversity))
+            return self.batcher.search(query, snap, options, key, self.deadline)
+
+        # Lexical-only mode answers without an embedding round trip
+        query_vec = (self.embedder.embed(query, deadline=self.deadline)
+                     if mode != "lexical" else None)
+        time_left(self.deadline)
+        # Only plain dense rankings depend on the vector alone; hybrid,
+        # lexical and pinned results also depend on the exact wording.
+        cache = snap.cache if mode == "dense" and pinned is None else None
+        if cache is not None:
+            key = self._cache_key(payload, top_k, nprobe, diversity)
+            results = cache.get(query_vec, key)
+            if results is not None:
+                return results
+        results = search(query_vec, snap.matrix, snap.metadata, top_k=top_k,
+                         ann=snap.ann, nprobe=nprobe, rows=rows,
+                         mode=mode, query=query, bm25=snap.bm25, pinned=pinned,
+                         groups=snap.groups, diversity=diversity,
+                         quantized=snap.quantized)
+        if cache is not None:
+            cache.put(query_vec, key, results)
+        return results
+
+    def _search_batch(self, payload: dict):
+        snap = self.snapshot
+        queries = payload.get("queries")
+        if (not isinstance(queries, list) or not queries
+                or not all(isinstance(q, str) and q for q in queries)):
+            self._respond(400, {"error": "Missing or invalid 'queries' field"})
+            return
+        if len(queries) > MAX_BATCH_QUERIES:
+            self._respond(400, {"error": f"At most {MAX_BATCH_QUERIES} queries per batch"})
+            return
+
+        try:
+            top_k, nprobe, rows, mode, diversity = self._params(payload, snap)
+            shape = self._shape(payload)
+        except (TypeError, ValueError) as e:
+            self._respond(400, {"error": str(e)})
+            return
+
+        try:
+            if rows is not None and len(rows) == 0:
+                self._respond(200, {"results": [[] for _ in queries]})
+                return
+            query_matrix = (self.embedder.embed_many(queries, deadline=self.deadline)
+                            if mode != "lexical" else None)
+            time_left(self.deadline)
+            cache = snap.cache if mode == "dense" else None
+            if cache is None:
+                results = search_many(query_matrix, snap.matrix, snap.metadata, top_k=top_k,
+                                      ann=snap.ann, nprobe=nprobe, rows=rows,
+                                      mode=mode, queries=queries, bm25=snap.bm25,
+                                      groups=snap.groups, diversity=diversity,
+                                      quantized=snap.quantized)
+                self._respond(200, {"results": [self._present(r, snap, shape) for r in results]})
+                return
+
+            # Score only the queries the cache can't answer, still as one batch
+            key = self._cache_key(payload, top_k, nprobe, diversity)
+            results = [cache.get(vec, key) for vec in query_matrix]
+            missing = [i for i, r in enumerate(results) if r is None]
+            if missing:
+                fresh = search_many(query_matrix[missing], snap.matrix, snap.metadata,
+                                    top_k=top_k, ann=snap.ann, nprobe=nprobe, rows=rows,
+                                    groups=snap.groups, diversity=diversity,
+                                    quantized=snap.quantized)
+                for i, r in zip(missing, fresh):
+                    results[i] = r
+                    cache.put(query_matrix[i], key, r)
+            self._respond(200, {"results": [self._present(r, snap, shape) for r in results]})
+        except (Overloaded, DeadlineExceeded) as e:
+            self._shed(e)
+        except Exception as e:
+            print(f"Search error: {e}", file=sys.stderr)
+            self._respond(500, {"error": str(e)})
+
+    def _search_vector(self, payload: dict):
+        """Dense search for precomputed query vectors; what a coordinator sends its shards.
+
+        "vector" (one base64 float32 vector) answers like /search, "vectors"
+        (a list) like /search_batch. Citation matching needs the query text,
+        so it does not apply here.
+        """
+        snap = self.snapshot
+        single = "vector" in payload
+        try:
+            query_matrix = decode_vectors([payload["vector"]] if single
+                                          else payload.get("vectors"), snap.matrix.shape[1])
+            top_k, nprobe, rows, mode, diversity = self._params(payload, snap)
+            shape = self._shape(payload)
+            if mode != "dense":
+                raise ValueError("/search_vector only supports mode 'dense'")
+        except (TypeError, ValueError) as e:
+            self._respond(400, {"error": str(e)})
+            return
+
+        try:
+            if rows is not None and len(rows) == 0:
+                results = [[] for _ in query_matrix]
+            else:
+                results = search_many(query_matrix, snap.matrix, snap.metadata, top_k=top_k,
+                                      ann=snap.ann, nprobe=nprobe, rows=rows,
+                                      groups=snap.groups, diversity=diversity,
+                                      quantized=snap.quantized)
+            time_left(self.deadline)
+            results = [self._present(r, snap, shape) for r in results]
+            self._respond(200, {"results": results[0] if single else results})
+        except DeadlineExceeded as e:
+            self._shed(e)
+        except Exception as e:
+            print(f"Search error: {e}", file=sys.stderr)
+            self._respond(500, {"error": str(e)})
+
+    @staticmethod
+    def _namespace(payload: dict) -> str:
+        namespace = payload.get("namespace", "")
+        if namespace:
+            raise ValueError("Only the default namespace (\"\") is supported")
+        return namespace
+
+    def _pinecone_query(self, payload: dict):
+        """Pinecone POST /query: top-k chunks by cosine, without section dedup."""
+        snap = self.snapshot
+        try:
+            namespace = self._namespace(payload)
+            top_k = int(payload.get("topK", payload.get("top_k", 10)))
+            if not 1 <= top_k <= PINECONE_MAX_TOP_K:
+                raise ValueError(f"'topK' must be between 1 and {PINECONE_MAX_TOP_K}")
+            if payload.get("id") is not None:
+                row = snap.neighbors.rows.get(payload["id"])
+                if row is None:
+                    raise ValueError(f"No vector with id {payload['id']!r}")
+                query_vec = np.asarray(snap.matrix[row], dtype=np.float32)
+            else:
+                query_vec = decode_vectors([payload.get("vector")], snap.matrix.shape[1])[0]
+            filters = payload.get("filter")
+            rows = snap.filters.match(filters) if filters else None
+            include_values = bool(payload.get("includeValues", payload.get("include_values")))
+            include_metadata = bool(payload.get("includeMetadata",
+                                                payload.get("include_metadata")))
+        except (TypeError, ValueError) as e:
+            self._respond(400, {"error": str(e)})
+            return
+
+        try:
+            if rows is not None and len(rows) == 0:
+                top, scores = [], []
+            else:
+                top, scores = dense_candidates(query_vec, snap.matrix, top_k, ann=snap.ann,
+                                               rows=rows, quantized=snap.quantized)
+            time_left(self.deadline)
+            matches = []
+            for row, score in zip(top, scores):
+                chunk = snap.metadata[row]
+                match = {"id": chunk.get("id", ""), "score": float(score)}
+                if include_values:
+                    match["values"] = snap.matrix[row].tolist()
+                if include_metadata:
+                    match["metadata"] = {k: v for k, v in chunk.items() if k != "id"}
+                matches.append(match)
+            self._respond(200, {"matches": matches, "namespace": namespace,
+                                "usage": {"readUnits": 1}})
+        except DeadlineExceeded as e:
+            self._shed(e)
         except Exception as e:
             print(f"Search error: {e}", file=sys.stderr)
             self._respond(500, {"error": str(e)})
 
+    def _writes_refused(self) -> bool:
+        """Answer 403 unless writes are on and the request carries the write key."""
+        if self.live is None:
+            self._respond(403, {"error": "Writes are off; start a single-process, unsharded "
+                                         "server with --allow-writes"})
+            return True
+        if self.write_key is not None and not hmac.compare_digest(
+                self.headers.get("Api-Key", "").encode(), self.write_key.encode()):
+            self._respond(403, {"error": "Missing or wrong Api-Key"})
+            return True
+        return False
+
+    def _pinecone_upsert(self, payload: dict):
+        """Pinecone POST /vectors/upsert; applied asynchronously by LiveUpdates."""
+        if self._writes_refused():
+            return
+        try:
+            self._namespace(payload)
+            vectors = payload.get("vectors")
+            if not isinstance(vectors, list) or not 1 <= len(vectors) <= PINECONE_MAX_UPSERT:
+                raise ValueError(f"'vectors' must be a list of 1 to {PINECONE_MAX_UPSERT} vectors")
+            dim = self.snapshot.matrix.shape[1]
+            records = []
+            for item in vectors:
+                chunk_id = item.get("id")
+                fields = item.get("metadata") or {}
+                if not isinstance(chunk_id, str) or not chunk_id:
+                    raise ValueError("Every vector needs a string 'id'")
+                if not isinstance(fields, dict):
+                    raise ValueError("'metadata' must be an object")
+                if not all(isinstance(fields.get(k, ""), str)
+                           for k in ("source", "file_path", "section_id", "text")):
+                    raise ValueError("'source', 'file_path', 'section_id' and 'text' "
+                                     "must be strings")
+                if not isinstance(fields.get("chunk_index", 0), int):
+                    raise ValueError("'chunk_index' must be an integer")
+                records.append((chunk_id, decode_vectors([item.get("values")], dim)[0], fields))
+        except (AttributeError, TypeError, ValueError) as e:
+            self._respond(400, {"error": str(e)})
+            return
+        self.live.upsert(records)
+        self._respond(200, {"upsertedCount": len(records)})
+
+    def _pinecone_delete(self, payload: dict):
+        """Pinecone POST /vectors/delete by ids, by metadata filter, or deleteAll."""
+        if self._writes_refused():
+            return
+        try:
+            self._namespace(payload)
+            if payload.get("deleteAll", payload.get("delete_all")):
+                self.live.delete_all()
+            elif payload.get("filter"):
+                snap = self.snapshot
+                self.live.delete([snap.metadata[row].get("id")
+                                  for row in snap.filters.match(payload["filter"])])
+            else:
+                ids = payload.get("ids")
+                if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+                    raise ValueError("Expected 'ids', 'filter' or 'deleteAll'")
+                self.live.delete(ids)
+        except (TypeError, ValueError) as e:
+            self._respond(400, {"error": str(e)})
+            return
+        self._respond(200, {})
+
+    def _describe_index_stats(self, payload: dict = None):
+        """Pinecone /describe_index_stats (GET or POST)."""
+        snap = self.snapshot
+        count = len(snap.metadata)
+        self._respond(200, {
+            "namespaces": {"": {"vectorCount": count}} if count else {},
+            "dimension": snap.matrix.shape[1],
+            "indexFullness": 0.0,
+            "totalVectorCount": count,
+        })
+
+    def _pinecone_fetch(self, query: dict):
+        """Pinecone GET /vectors/fetch?ids=...: stored vectors and metadata by id."""
+        snap = self.snapshot
+        ids = query.get("ids", [])
+        if not ids or len(ids) > PINECONE_MAX_FETCH or any(query.get("namespace", [""])):
+            self._respond(400, {"error": f"Pass 1 to {PINECONE_MAX_FETCH} 'ids' "
+                                         "in the default namespace"})
+            return
+        vectors = {}
+        for chunk_id in ids:
+            row = snap.neighbors.rows.get(chunk_id)
+            if row is not None:
+                chunk = snap.metadata[row]
+                vectors[chunk_id] = {"id": chunk_id, "values": snap.matrix[row].tolist(),
+                                     "metadata": {k: v for k, v in chunk.items() if k != "id"}}
+        self._respond(200, {"vectors": vectors, "namespace": "", "usage": {"readUnits": 1}})
+
     def do_GET(self):
+        start = time.perf_counter()
+        try:
+            if self.path.startswith("/debug/"):
+                self._debug(urlsplit(self.path))
+            else:
+                self._handle_get()
+        finally:
+            if self.path != "/metrics":
+                self._observe(start)
+
+    def _handle_get(self):
+        url = urlsplit(self.path)
+        if url.path == "/vectors/fetch":
+            self._pinecone_fetch(parse_qs(url.query))
+            return
+        if url.path == "/describe_index_stats":
+            self._describe_index_stats()
+            return
+        if self.path == "/metrics":
+            body = render_metrics(self.snapshot, self.admission, self.embedder.breaker).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
         if self.path == "/health":
+            snap = self.snapshot
             self._respond(200, {
                 "status": "ok",
-                "chunks": len(self.metadata),
+                "pid": os.getpid(),
+                "chunks": len(snap.metadata),
+                "ann": f"ivf:{snap.ann.nlist}" if snap.ann is not None else None,
+                "corpus": snap.describe(),
+                "cache": snap.cache.describe() if snap.cache is not None else None,
+                "precision": snap.quantized.describe() if snap.quantized is not None else None,
+                "admission": {"active": self.admission.active, "queued": self.admission.waiting},
+                "embeddings_circuit": self.embedder.breaker.state,
             })
             return
         self.send_error(404, "Not found")
 
-    def _respond(self, status: int, data: dict):
-        body = json.dumps(data).encode()
+    def _debug(self, url):
+        """Profile or inspect the live process; localhost only, with the debug token.
+
+        GET /debug/profile?seconds=N or ?requests=N samples thread stacks and
+        returns collapsed stacks (format=collapsed, the default) or a pstats
+        dump (format=pstats); threads=all also samples idle threads.
+        GET /debug/memory?top=N reports structure sizes and tracemalloc's top
+        allocation sites; trace=start|stop toggles tracemalloc. Under
+        --workers each request reaches one worker, which reports on itself.
+        """
+        if self.debug_token is None or url.path not in ("/debug/profile", "/debug/memory"):
+            self.send_error(404, "Not found")
+            return
+        if not self._is_local():
+            self._respond(403, {"error": "Debug endpoints only answer local clients"})
+            return
+        if not hmac.compare_digest(self.headers.get("Authorization", "").encode(),
+                                   f"Bearer {self.debug_token}".encode()):
+            self._respond(401, {"error": "Missing or wrong debug token"})
+            return
+
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            if url.path == "/debug/memory":
+                trace = query.get("trace")
+                if trace not in (None, "start", "stop"):
+                    raise ValueError("'trace' must be start or stop")
+                if trace == "start" and not tracemalloc.is_tracing():
+                    tracemalloc.start(TRACEMALLOC_FRAMES)
+                elif trace == "stop":
+                    tracemalloc.stop()
+                self._respond(200, memory_report(self.snapshot, int(query.get("top", 20))))
+                return
+
+            seconds = float(query.get("seconds", PROFILE_SECONDS))
+            requests = int(query["requests"]) if "requests" in query else None
+            if not 0 < seconds <= PROFILE_MAX_SECONDS:
+                raise ValueError(f"'seconds' must be between 0 and {PROFILE_MAX_SECONDS:g}")
+            fmt = query.get("format", "collapsed")
+            if fmt not in ("collapsed", "pstats"):
+                raise ValueError("'format' must be collapsed or pstats")
+        except ValueError as e:
+            self._respond(400, {"error": str(e)})
+            return
+
+        busy = None
+        if query.get("threads") != "all":
+            busy = frozenset(f.__code__ for f in (
+                SearchHandler.do_POST, SearchHandler.do_GET, MicroBatcher._run,
+                EmbeddingClient._call, LiveUpdates._apply))
+        profiler = SamplingProfiler(busy=busy)
+        profiler.run(seconds, requests)
+        if fmt == "pstats":
+            body, content_type = profiler.pstats(), "application/octet-stream"
+        else:
+            body, content_type = profiler.collapsed().encode(), "text/plain; charset=utf-8"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Profile-Samples", str(profiler.rounds))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _is_local(self) -> bool:
+        return self.client_address[0] in ("127.0.0.1", "::1")
+
+    def _respond(self, status: int, data: dict, headers: dict = None):
+        with STAGE_SECONDS.time(stage="serialize"):
+            body = dumps(data)
+        with STAGE_SECONDS.time(stage="compress"):
+            body, encoding = compress(body, self.headers.get("Accept-Encoding", ""))
         self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
         self.send_header("Content-Type", "application/json")
         self.send_header("Content-Length", str(len(body)))
         self.end_headers()
@@ -187,30 +3579,495 @@ class SearchHandler(BaseHTTPRequestHandler):
         print(f"[search] {args[0]}")
 
 
-def main():
-    load_env_paths(ENV_PATHS)
+class UnixSearchHandler(SearchHandler):
+    """SearchHandler for co-located clients on a Unix domain socket.
 
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
-        print("Error: OPENAI_API_KEY not found in .env.local or environment", file=sys.stderr)
-        sys.exit(1)
+    HTTP/1.1 keeps each client connection open between requests, so a
+    search pays neither connection setup nor TCP's loopback overhead.
+    Only processes allowed to open the socket file can connect.
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = False  # TCP_NODELAY doesn't apply to AF_UNIX
+    timeout = UNIX_IDLE_TIMEOUT
+
+    def address_string(self):
+        return "unix"  # AF_UNIX peers have no address
+
+    def _is_local(self) -> bool:
+        return True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ThreadingHTTPServer's counterpart on a Unix domain socket.
+
+    Request threads are daemons: idle keep-alive connections would
+    otherwise hold up server_close() until they time out.
+    """
+    daemon_threads = True
+
+
+class CoordinatorHandler(SearchHandler):
+    """/search and /search_batch answered by scatter-gather over shard servers.
+
+    Queries are embedded here once and only the vectors travel to the
+    shards. Scoring is dense only: BM25 statistics, RRF ranks and MMR
+    re-ranking are per shard and don't merge by score, and citation
+    lookup is not available without the corpus. Neither is 'context':
+    a section's neighbours across a section boundary may live on another
+    shard.
+    """
+    coordinator = None
+
+    ENDPOINTS = ("/search", "/search_batch", "/health", "/metrics")
+    ROUTES = {"/search": "_search", "/search_batch": "_search_batch"}
+
+    @staticmethod
+    def _options(payload: dict):
+        """Parse (top_k, options passed to the shards); the shards validate the filter.
+
+        Raises ValueError for malformed values, reported to the client as a 400.
+        """
+        top_k = min(int(payload.get("top_k", TOP_K)), MAX_TOP_K)
+        if payload.get("mode", "dense") != "dense":
+            raise ValueError("Sharded search only supports mode 'dense'")
+        if float(payload.get("diversity", 0.0)) != 0.0:
+            raise ValueError("Sharded search does not support 'diversity'")
+        if payload.get("context") is not None:
+            raise ValueError("Sharded search does not support 'context'")
+        options = {"filter": payload.get("filter")}
+        if payload.get("nprobe") is not None:
+            options["nprobe"] = int(payload["nprobe"])
+        return top_k, options
+
+    def _scatter(self, queries: list, payload: dict):
+        """Embed the queries and search the shards; returns one result list per query."""
+        try:
+            top_k, options = self._options(payload)
+            fields, snippet_chars, _, _ = self._shape(payload)
+        except (TypeError, ValueError) as e:
+            self._respond(400, {"error": str(e)})
+            return None
+        try:
+            query_matrix = self.embedder.embed_many(queries, deadline=self.deadline)
+            time_left(self.deadline)
+            return self.coordinator.search_many(query_matrix, top_k, options, fields,
+                                                snippet_chars, deadline=self.deadline)
+        except ValueError as e:  # a shard rejected the request (e.g. bad filter)
+            self._respond(400, {"error": str(e)})
+        except (Overloaded, DeadlineExceeded) as e:
+            self._shed(e)
+        except ShardError as e:
+            print(f"Search error: {e}", file=sys.stderr)
+            self._respond(502, {"error": str(e)})
+        except Exception as e:
+            print(f"Search error: {e}", file=sys.stderr)
+            self._respond(500, {"error": str(e)})
+        return None
+
+    def _search(self, payload: dict):
+        query = payload.get("query")
+        if not query or not isinstance(query, str):
+            self._respond(400, {"error": "Missing or invalid 'query' field"})
+            return
+        results = self._scatter([query], payload)
+        if results is not None:
+            self._respond(200, {"results": results[0]})
+
+    def _search_batch(self, payload: dict):
+        queries = payload.get("queries")
+        if (not isinstance(queries, list) or not queries
+                or not all(isinstance(q, str) and q for q in queries)):
+            self._respond(400, {"error": "Missing or invalid 'queries' field"})
+            return
+        if len(queries) > MAX_BATCH_QUERIES:
+            self._respond(400, {"error": f"At most {MAX_BATCH_QUERIES} queries per batch"})
+            return
+        results = self._scatter(queries, payload)
+        if results is not None:
+            self._respond(200, {"results": results})
+
+    def _handle_get(self):
+        if self.path == "/metrics":
+            body = render_metrics(None, self.admission, self.embedder.breaker).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path == "/health":
+            self._respond(200, {
+                "status": "ok",
+                "pid": os.getpid(),
+                "shards": [shard.url for shard in self.coordinator.shards],
+                "admission": {"active": self.admission.active, "queued": self.admission.waiting},
+                "embeddings_circuit": self.embedder.breaker.state,
+            })
+            return
+        self.send_error(404, "Not found")
 
-    metadata, matrix = load_chunks(CHUNKS_PATH)
 
-    SearchHandler.metadata = metadata
-    SearchHandler.matrix = matrix
-    SearchHandler.api_key = api_key
+def parse_args():
+    parser = argparse.ArgumentParser(description="BenchBook AI local vector search server")
+    parser.add_argument("--port", type=int, default=PORT,
+                        help="Port to listen on")
+    parser.add_argument("--unix-socket", type=Path, default=None, metavar="PATH",
+                        help="Also serve the API on this Unix domain socket, with keep-alive, "
+                             "for clients on the same host")
+    parser.add_argument("--corpus", type=Path, default=CHUNKS_PATH,
+                        help="Embedded chunks JSON to serve")
+    parser.add_argument("--embedding-url", default=EMBEDDING_URL,
+                        help="Embeddings endpoint (OpenAI-compatible)")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE,
+                        help="Max keep-alive connections to the embeddings API")
+    parser.add_argument("--keep-warm", type=int, default=POOL_KEEP_WARM,
+                        help="Idle connections to the embeddings API kept open through quiet "
+                             "periods, so the first query after one skips the handshake "
+                             "(0 = off)")
+    parser.add_argument("--connect-timeout", type=float, default=CONNECT_TIMEOUT,
+                        help="Seconds allowed for TCP connect + TLS handshake")
+    parser.add_argument("--read-timeout", type=float, default=READ_TIMEOUT,
+                        help="Seconds to wait for an embeddings response")
+    parser.add_argument("--embed-timeout", type=float, default=EMBED_TIMEOUT,
+                        help="Seconds an embeddings call may take, hedged duplicate included")
+    parser.add_argument("--hedge-percentile", type=float, default=HEDGE_PERCENTILE,
+                        help="Send a duplicate embeddings call when one runs longer than this "
+                             "percentile of recent calls (0 = never)")
+    parser.add_argument("--deadline", type=float, default=REQUEST_DEADLINE,
+                        help="Seconds a search may take end to end; clients may ask for "
+                             "less with timeout_ms")
+    parser.add_argument("--max-active", type=int, default=MAX_ACTIVE,
+                        help="Searches processed at once (per worker)")
+    parser.add_argument("--max-queued", type=int, default=MAX_QUEUED,
+                        help="Searches allowed to wait for a slot before new ones get 503")
+    parser.add_argument("--breaker-failures", type=int, default=BREAKER_FAILURES,
+                        help="Consecutive embeddings failures that open the circuit breaker")
+    parser.add_argument("--breaker-reset", type=float, default=BREAKER_RESET,
+                        help="Seconds the circuit stays open before a trial request")
+    parser.add_argument("--ann", choices=["none", "ivf"], default="none",
+                        help="Approximate index to use instead of exact brute-force scoring")
+    parser.add_argument("--nlist", type=int, default=None,
+                        help="IVF inverted lists (default: sqrt of corpus size)")
+    parser.add_argument("--nprobe", type=int, default=ANN_NPROBE,
+                        help="IVF lists scanned per query (overridable per request)")
+    parser.add_argument("--ann-recall-check", action="store_true",
+                        help="Report IVF recall@10 against brute force at startup")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float32",
+                        help="Score against a float16/int8 copy of the matrix, re-ranking "
+                             "the best candidates in float32 from a memory-mapped file")
+    parser.add_argument("--precision-recall-check", action="store_true",
+                        help="Report recall@10 of --precision scoring against float32 at startup")
+    parser.add_argument("--reload-interval", type=float, default=RELOAD_INTERVAL,
+                        help="Seconds between checks for a new corpus file (0 = only on SIGHUP)")
+    parser.add_argument("--cache-size", type=int, default=QUERY_CACHE_SIZE,
+                        help="Recent queries kept in the semantic result cache (0 = off)")
+    parser.add_argument("--cache-threshold", type=float, default=QUERY_CACHE_THRESHOLD,
+                        help="Cosine similarity at which a cached query's results are reused")
+    parser.add_argument("--batch-window", type=float, default=BATCH_WINDOW,
+                        help="Seconds to gather concurrent searches into one embeddings call "
+                             "and scoring pass (0 = off)")
+    parser.add_argument("--batch-max", type=int, default=BATCH_MAX,
+                        help="Most searches embedded and scored together")
+    parser.add_argument("--no-coalesce", dest="coalesce", action="store_false",
+                        help="Don't share one embedding call and scoring pass between "
+                             "identical concurrent searches")
+    parser.add_argument("--allow-writes", action="store_true",
+                        help="Accept Pinecone /vectors/upsert and /vectors/delete (kept in "
+                             f"memory only; ${WRITE_KEY_ENV} sets a required Api-Key). Each "
+                             "batch of writes copies the full matrix and rebuilds BM25, IVF "
+                             "k-means and the quantized matrix")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="Trace allocations from startup so /debug/memory can attribute "
+                             "the matrix, metadata and caches")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Pre-fork N worker processes sharing one copy of the matrix")
+    parser.add_argument("--shard", type=parse_shard, default=None, metavar="I/N",
+                        help="Serve only the sections that hash to shard I of N")
+    parser.add_argument("--shards", default="",
+                        help="Run as a coordinator over these comma-separated shard URLs")
+    parser.add_argument("--spawn-shards", type=int, default=0, metavar="N",
+                        help="Run as a coordinator over N local shard processes on the "
+                             "ports after --port")
+    return parser.parse_args()
 
-    server = HTTPServer((HOST, PORT), SearchHandler)
-    print(f"Search server listening on http://{HOST}:{PORT}")
+
+def start_server(snapshot: CorpusSnapshot, port: int = PORT) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((HOST, port), SearchHandler)
+    print(f"Search server listening on http://{HOST}:{port}")
     print(f"  POST /search  — query the corpus")
+    print(f"  POST /search_batch — several queries in one call")
+    print(f"  POST /search_vector — query with precomputed vectors")
     print(f"  GET  /health   — health check")
+    print(f"  GET  /metrics  — Prometheus metrics")
+    print(f"  Corpus version {snapshot.version}; send SIGHUP to reload")
+    return server
+
+
+def start_unix_server(path: Path) -> UnixHTTPServer:
+    """Listen on a Unix domain socket at `path`, replacing a stale socket file."""
+    if path.is_socket():
+        path.unlink()
+    old_umask = os.umask(0o777 & ~UNIX_SOCKET_MODE)  # no window with a wider mode
+    try:
+        server = UnixHTTPServer(str(path), UnixSearchHandler)
+    finally:
+        os.umask(old_umask)
+    print(f"Search server also listening on unix:{path} (HTTP/1.1 keep-alive)")
+    return server
 
+
+def stop_unix_server(server: UnixHTTPServer) -> None:
+    server.server_close()
+    try:
+        os.unlink(server.server_address)
+    except FileNotFoundError:
+        pass
+
+
+def start_embedder(snapshot: CorpusSnapshot, args, api_key: str) -> EmbeddingClient:
+    """Create the embeddings client and warm up connections and the scoring path."""
+    embedder = EmbeddingClient(api_key, url=args.embedding_url, pool_size=args.pool_size,
+                               connect_timeout=args.connect_timeout,
+                               read_timeout=args.read_timeout,
+                               breaker=CircuitBreaker(args.breaker_failures, args.breaker_reset),
+                               timeout=args.embed_timeout,
+                               hedge_percentile=args.hedge_percentile)
+    # Pre-open connections and prime the scoring path so the first query
+    # doesn't pay for the TLS handshake or BLAS initialization; keep_warm()
+    # keeps that true after quiet periods longer than the idle timeout.
+    opened = embedder.pool.warm_up()
+    if args.keep_warm > 0:
+        embedder.pool.keep_warm(min(args.keep_warm, args.pool_size))
+    if snapshot is not None and len(snapshot.metadata):
+        search(snapshot.matrix[0], snapshot.matrix, snapshot.metadata, ann=snapshot.ann,
+               groups=snapshot.groups, quantized=snapshot.quantized)
+    print(f"[{os.getpid()}] Warmed {opened} connection(s) to {embedder.pool.host}")
+    return embedder
+
+
+def start_batcher(embedder: EmbeddingClient, admission: AdmissionControl, args):
+    """The worker's MicroBatcher, or None when --batch-window is 0."""
+    if args.batch_window <= 0:
+        return None
+    return MicroBatcher(embedder, window=args.batch_window, max_batch=args.batch_max,
+                        admission=admission, workers=args.pool_size)
+
+
+def serve_single(args, api_key: str) -> None:
+    """One process: request threads plus a background reloader thread."""
+    snapshot = load_snapshot(args.corpus, args)
+    embedder = start_embedder(snapshot, args, api_key)
+    SearchHandler.snapshot = snapshot
+    SearchHandler.embedder = embedder
+    SearchHandler.admission = AdmissionControl(args.max_active, args.max_queued)
+    SearchHandler.request_deadline = args.deadline
+    SearchHandler.flights = SingleFlight() if args.coalesce else None
+    SearchHandler.batcher = start_batcher(embedder, SearchHandler.admission, args)
+
+    def install(new_snapshot):
+        SearchHandler.snapshot = new_snapshot  # single reference swap
+
+    if args.allow_writes:
+        live = LiveUpdates(args, lambda: SearchHandler.snapshot, install)
+        live.start()
+        SearchHandler.live = live
+
+        def install_reload(new_snapshot):
+            with live.lock:  # never interleave with a snapshot built from writes
+                install(new_snapshot)
+    else:
+        install_reload = install
+
+    reloader = CorpusReloader(args.corpus, args, install_reload, interval=args.reload_interval)
+    reloader.start()
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reloader.request_reload())
+
+    server = start_server(snapshot, args.port)
+    unix_server = start_unix_server(args.unix_socket) if args.unix_socket else None
+    if unix_server is not None:
+        threading.Thread(target=unix_server.serve_forever, name="unix-server",
+                         daemon=True).start()
+    del snapshot  # SearchHandler.snapshot is the only live reference
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print("\nShutting down.")
         server.server_close()
+        if unix_server is not None:
+            stop_unix_server(unix_server)
+        embedder.pool.close()
+
+
+def serve_prefork(args, api_key: str) -> None:
+    """N forked workers accepting on the same socket; the parent supervises and reloads."""
+    if not hasattr(os, "fork"):
+        print("Error: --workers requires a platform with fork()", file=sys.stderr)
+        sys.exit(1)
+
+    snapshot = load_snapshot(args.corpus, args)
+    server = start_server(snapshot, args.port)
+    # Workers run request threads to completion on shutdown instead of
+    # abandoning them as daemon threads.
+    server.daemon_threads = False
+    unix_server = start_unix_server(args.unix_socket) if args.unix_socket else None
+
+    def run_worker(worker_server, worker_snapshot):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent handles Ctrl-C
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)  # ...and reloads
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(
+            target=worker_server.shutdown, daemon=True).start())
+        SearchHandler.snapshot = worker_snapshot
+        SearchHandler.embedder = embedder = start_embedder(worker_snapshot, args, api_key)
+        SearchHandler.admission = AdmissionControl(args.max_active, args.max_queued)
+        SearchHandler.request_deadline = args.deadline
+        SearchHandler.flights = SingleFlight() if args.coalesce else None
+        SearchHandler.batcher = start_batcher(embedder, SearchHandler.admission, args)
+        if unix_server is not None:
+            threading.Thread(target=unix_server.serve_forever, name="unix-server",
+                             daemon=True).start()
+        worker_server.serve_forever()
+        if unix_server is not None:
+            unix_server.shutdown()
+        worker_server.server_close()  # waits for in-flight requests
+        # Unix socket request threads are daemons; let admitted searches finish
+        give_up = time.monotonic() + args.deadline
+        while SearchHandler.admission.active and time.monotonic() < give_up:
+            time.sleep(0.05)
+        embedder.pool.close()
+
+    supervisor = PreforkSupervisor(server, args.workers, run_worker)
+    supervisor.install(snapshot)
+    del snapshot  # the supervisor owns it, so a reload can free the old matrix
+    quantized = supervisor.snapshot.quantized
+    shared = supervisor.snapshot.matrix if quantized is None else quantized.codes
+    print(f"Started {args.workers} workers sharing a {shared.nbytes / 1e6:.1f} MB "
+          f"{args.precision} matrix")
+
+    reloader = CorpusReloader(args.corpus, args, supervisor.install, interval=args.reload_interval)
+    signal.signal(signal.SIGHUP, lambda signum, frame: reloader.request_reload())
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # raise KeyboardInterrupt
+
+    try:
+        while True:
+            supervisor.reap()
+            reloader.tick(timeout=0.5)
+    except KeyboardInterrupt:
+        print("\nShutting down workers.")
+        supervisor.stop()
+        server.server_close()
+        if unix_server is not None:
+            stop_unix_server(unix_server)
+
+
+def spawn_shards(args) -> list:
+    """Start `args.spawn_shards` shard processes of this script; returns (url, process) pairs.
+
+    Each shard gets the command line's corpus and serving options, with
+    its own --shard and --port.
+    """
+    coordinator_only = {"--port", "--shards", "--spawn-shards"}
+    argv = []
+    skip = False
+    for arg in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif arg.split("=", 1)[0] in coordinator_only:
+            skip = "=" not in arg
+        else:
+            argv.append(arg)
+    shards = []
+    for index in range(args.spawn_shards):
+        port = args.port + 1 + index
+        process = subprocess.Popen([sys.executable, sys.argv[0], *argv,
+                                    "--shard", f"{index}/{args.spawn_shards}",
+                                    "--port", str(port)])
+        shards.append((f"http://{HOST}:{port}", process))
+    return shards
+
+
+def wait_for_shards(urls: list, processes: list) -> None:
+    """Block until every shard answers /health, failing if a spawned shard exits first."""
+    pending = list(urls)
+    while pending:
+        for process in processes:
+            if process.poll() is not None:
+                raise RuntimeError(f"Shard process {process.pid} exited with {process.returncode}")
+        pool = ConnectionPool(pending[0], size=1, connect_timeout=SHARD_STARTUP_POLL)
+        try:
+            status, _ = pool.request("GET", "/health")
+        except OSError:
+            status = None
+        finally:
+            pool.close()
+        if status == 200:
+            pending.pop(0)
+        else:
+            time.sleep(SHARD_STARTUP_POLL)
+
+
+def serve_coordinator(args, api_key: str) -> None:
+    """Embed queries here and scatter-gather the scoring over shard servers."""
+    spawned = spawn_shards(args) if args.spawn_shards else []
+    processes = [process for _, process in spawned]
+    urls = [url for url in args.shards.split(",") if url] + [url for url, _ in spawned]
+    server = None
+    try:
+        print(f"Waiting for {len(urls)} shard(s) ...")
+        wait_for_shards(urls, processes)
+        CoordinatorHandler.coordinator = coordinator = ShardCoordinator(
+            urls, pool_size=args.max_active, connect_timeout=args.connect_timeout,
+            read_timeout=args.read_timeout)
+        CoordinatorHandler.embedder = embedder = start_embedder(None, args, api_key)
+        CoordinatorHandler.admission = AdmissionControl(args.max_active, args.max_queued)
+        CoordinatorHandler.request_deadline = args.deadline
+
+        server = ThreadingHTTPServer((HOST, args.port), CoordinatorHandler)
+        print(f"Search coordinator listening on http://{HOST}:{args.port} "
+              f"over {len(urls)} shard(s):")
+        for url in urls:
+            print(f"  {url}")
+        signal.signal(signal.SIGTERM, signal.default_int_handler)  # raise KeyboardInterrupt
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down.")
+        if server is not None:
+            server.server_close()
+            coordinator.close()
+            embedder.pool.close()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main():
+    args = parse_args()
+    load_env_paths(ENV_PATHS)
+    if args.tracemalloc:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    SearchHandler.debug_token = os.environ.get(DEBUG_TOKEN_ENV) or None
+    SearchHandler.write_key = os.environ.get(WRITE_KEY_ENV) or None
+
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        print("Error: OPENAI_API_KEY not found in .env.local or environment", file=sys.stderr)
+        sys.exit(1)
+
+    if args.allow_writes and (args.shards or args.spawn_shards or args.shard is not None
+                              or args.workers > 1):
+        print("Error: --allow-writes needs a single-process, unsharded server", file=sys.stderr)
+        sys.exit(1)
+    if args.shards or args.spawn_shards:
+        if args.unix_socket:
+            print("Error: --unix-socket is not supported by a coordinator", file=sys.stderr)
+            sys.exit(1)
+        serve_coordinator(args, api_key)
+    elif args.workers > 1:
+        serve_prefork(args, api_key)
+    else:
+        serve_single(args, api_key)
 
 
 if __name__ == "__main__":
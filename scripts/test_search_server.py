@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Unit tests for search_server.py.
+
+Usage:
+    python3 -m unittest discover scripts
+"""
+
+import socket
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from search_server import (HEDGES, CircuitBreaker, ConnectionPool, DeadlineExceeded,
+                           EmbeddingClient, IVFIndex, Overloaded, QuantizedMatrix,
+                           dense_candidates)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def open_breaker(self) -> CircuitBreaker:
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+        breaker.failure()
+        self.assertEqual(breaker.state, "open")
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, "half_open")
+        return breaker
+
+    def test_trial_call_past_its_deadline_allows_another_trial(self):
+        breaker = self.open_breaker()
+        # Nothing listens on port 9; the expired deadline stops the call first.
+        client = EmbeddingClient("key", url="http://127.0.0.1:9/v1/embeddings",
+                                 breaker=breaker, hedge_percentile=0)
+        with self.assertRaises(DeadlineExceeded):
+            client.embed("x", deadline=time.monotonic() - 1)
+        self.assertTrue(breaker.before())  # the next call is the new trial
+        with self.assertRaises(Overloaded):
+            breaker.before()  # ...and only one trial runs at a time
+
+    def test_trial_success_closes_and_failure_reopens(self):
+        breaker = self.open_breaker()
+        self.assertTrue(breaker.before())
+        breaker.success()
+        self.assertEqual(breaker.state, "closed")
+        self.assertFalse(breaker.before())
+
+        breaker = self.open_breaker()
+        self.assertTrue(breaker.before())
+        breaker.failure()
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(Overloaded):
+            breaker.before()
+
+    def test_caller_deadlines_do_not_open_the_breaker(self):
+        client = EmbeddingClient("key", url=silent_listener(self), hedge_percentile=0,
+                                 breaker=CircuitBreaker(threshold=2, reset_timeout=60))
+        for _ in range(5):
+            with self.assertRaises(DeadlineExceeded):
+                client.embed("x", deadline=time.monotonic() + 0.05)
+        self.assertEqual(client.breaker.state, "closed")
+        self.assertEqual(client.breaker.failures, 0)
+
+    def test_embed_timeouts_count_against_the_api(self):
+        client = EmbeddingClient("key", url=silent_listener(self), hedge_percentile=0,
+                                 breaker=CircuitBreaker(threshold=2, reset_timeout=60),
+                                 timeout=0.05)
+        for _ in range(2):
+            with self.assertRaises(DeadlineExceeded):
+                client.embed("x")
+        self.assertEqual(client.breaker.state, "open")
+
+
+def silent_listener(test: unittest.TestCase) -> str:
+    """URL of a socket that accepts connections but never answers."""
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+    test.addCleanup(listener.close)
+    return f"http://127.0.0.1:{listener.getsockname()[1]}/"
+
+
+class HedgingTest(unittest.TestCase):
+
+    def test_no_hedge_once_the_deadline_has_passed(self):
+        client = EmbeddingClient("key", url=silent_listener(self))
+        for _ in range(30):
+            client.latency.observe(5.0)
+        issued = HEDGES.total()
+        with self.assertRaises(DeadlineExceeded):
+            client.embed("x", deadline=time.monotonic() + 0.3)
+        self.assertEqual(HEDGES.total(), issued)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def test_keep_warm_outlasts_the_idle_timeout(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        pool = ConnectionPool(f"http://127.0.0.1:{server.server_address[1]}/", size=2,
+                              idle_timeout=0.4)
+        self.addCleanup(pool.close)
+        pool.warm_up(1)
+        pool.keep_warm(1)
+        time.sleep(1.0)  # more than twice the idle timeout
+        conn, reused = pool._checkout()
+        self.assertTrue(reused)
+        conn.close()
+
+
+class QuantizedIVFTest(unittest.TestCase):
+
+    def test_quantized_ann_ranks_like_float32_when_every_list_is_probed(self):
+        rng = np.random.default_rng(4)
+        matrix = rng.standard_normal((60, 32), dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        ann = IVFIndex.build(matrix, nlist=4, seed=4)
+        # Probing every list yields all rows, in probe order rather than sorted
+        candidates = ann.candidates(matrix[0], ann.nlist)
+        self.assertEqual(sorted(candidates), list(range(len(matrix))))
+        self.assertNotEqual(list(candidates), sorted(candidates))
+        for precision in ("int8", "float16"):
+            quantized = QuantizedMatrix.build(matrix, precision)
+            for row in range(len(matrix)):
+                query = matrix[row]
+                expected, _ = dense_candidates(query, matrix, 5, ann=ann, nprobe=ann.nlist)
+                got, _ = dense_candidates(query, matrix, 5, ann=ann, nprobe=ann.nlist,
+                                          quantized=quantized)
+                self.assertEqual(list(got), list(expected), (precision, row))
+
+
+if __name__ == "__main__":
+    unittest.main()